@@ -12,9 +12,12 @@ from modules.get_descriptors import calc_descr
 from modules.get_nn import calc_nn
 from modules.img_repr import get_repr
 from modules.classifier import train_elm, run_elm
+from nn.ivf import build_ivf
+from nn.centroids import has_store, convert_centroids, load_ivf
 from mp.mp_support import *
 from mp.mp_worker import MPWorker
 import sys
+import os
 import cProfile
 
 ##############################################################################
@@ -22,6 +25,11 @@ print "IBC started"
 #profiler = cProfile.Profile()
 #profiler.enable()
 
+if os.path.isfile(cf._C_file):
+    if (cf._C_dir != "") and (not has_store()):
+        convert_centroids()  # workers memory-map centroids from there
+    if (cf._nn_index == "ivf") and (load_ivf() is None):
+        build_ivf()  # before workers start, they load the index
 mp_start()
 init_hdf5()
 normalize_images()
@@ -29,7 +37,8 @@ calc_descr(kill_workers=False)
 mp_boost_nn()
 calc_nn(kill_workers=True)
 mp_finalize()
-get_repr(all_repr=False)
+if cf._nn_store:  # otherwise representations come from workers
+    get_repr(all_repr=False)
 #train_elm()
 run_elm(save_txt=True)
 
@@ -24,18 +24,30 @@ class IBCConfig(object):
     _mode = "demo"  # its either "hdf5" or something else
     _hdf5 = _dir + "spiiras.h5"
     _img_data = _dir + "imgdata.pkl"
+    _demo_store = _dir + "demo_store/"  # columns of demo mode data
     
     # m03: img_preprocessor
     _img_dir = _dir + "images/"
+    _save_img = True  # if False, _img_dir is not written in "shm" handoff
     _min_size = 2400
     _max_dim = 500
     _jpeg_quality = 95
+    _fast_resize = False  # decode large JPEGs at reduced scale
+    _norm_wrk = 8  # processes normalizing images, 1 to do it in main process
+    _manifest = _dir + "manifest.pkl"  # normalized images, "" to redo all
     
     # m04: get_descriptors
     _temp_dir = "/run/shm/"
+    _img_handoff = "jpeg"  # "shm" decodes raw images to _temp_dir in workers
     _descr_extractor = "csift"
     _max_reg = 10000  # maximum number of regions
     _cD_bin = _ibc + "sift/colorDescriptor"
+    _descr_batch = 16  # images per one extractor run, 1 to run separately
+    _cD_suffix = ".descr"  # added to image names in batch outputs
+    _descr_cache = _dir + "descr_cache/"  # by image SHA1, "" to disable
+    _write_batch = 10000  # regions appended to HDF5 or demo store at once
+    _descr_layout = "table"  # "earray" for compressed arrays, new files only
+    _descr_complib = "blosc:lz4"  # compressor for "earray" layout
      
     # m05: get_centroids
     _C_file = _dir + "C.pkl"
@@ -43,20 +55,35 @@ class IBCConfig(object):
         # contains: C["C"] = centroids
         #           C["L_majority"] = majority labels
         #           C["L_soft"] = soft labels
+    _C_dir = _dir + "C/"  # memory-mapped binary _C_file, "" to disable
+    _C_ivf = _dir + "C_ivf.pkl"  # approximate search index for _C_file
     
     # m06: run_nn
     _nn_count = 10
     _nn_batch = 100
+    _nn_engine = "gemm"  # "gemm" for BLAS, "uint8" exact, "cdist" scipy
+    _nn_dtype = "float64"  # "float32" is 2x faster, distances less precise
+    _nn_block = 16384  # centroids per distance matrix block
+    _nn_index = ""  # "ivf" for approximate search, "" for exact
+    _ivf_lists = 0  # clusters in the index, 0 for sqrt(number of centroids)
+    _ivf_probe = 8  # clusters to search, more is slower but more precise
+    _nn_store = True  # False: workers return image representations only
     
+    # m07: img_repr
+    _repr_batch = 1000000  # regions read at once for image representations
+
     # m08: elm_classifier
     _train_size = 15000
     _val_size = 5000
     _neurons = 50
     _elm_rep = 100  # ELM re-train repetitions for validation
     _elm_param = _dir + "ELM.pkl"
+    _data_mmap = ""  # folder for memory-mapped ELM data, "" to keep in RAM
 
     # saving results
     _f_out = _dir + "out.txt"
+    _stream_depth = 16  # websites in progress at once in "ibc_stream.py"
+    _stream_timeout = 3600  # seconds before "ibc_stream.py" gives up a website
 
     # multiprocessing config
     _nr_wrk = 7  # a good guess is the number of cores - 1
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Streaming classification of websites, with bounded memory.
+
+Each website from "_ws_descr" goes through all stages in one worker
+process: images are decoded and resized in memory, descriptors extracted
+with one "colorDescriptor" run, nearest centroids found and image
+representations computed. ELM runs in the main process, and a website
+result is written to "_f_out" as soon as the website is done.
+
+At most "_stream_depth" websites are in progress at once, and nothing
+is kept for finished ones, so memory does not depend on the number of
+websites. Nothing is written to "_img_dir" or "_hdf5". Workers keep their
+own centroids and labels, memory-mapped from "_C_dir" if it exists.
+Websites which failed are reported to stderr, not to "_f_out".
+
+Usage: "python ibc_stream.py [ws_descr_file]"
+"""
+
+from ibc_config import IBCConfig as cf
+from modules.img_preprocessor import _decode
+from modules.img_repr import Repr
+from sift.csift_extractor import csift_batch
+from nn.pdist import PDist
+from nn.centroids import has_store, convert_centroids
+from elm.elm import ELM
+from multiprocessing import Pool
+import Queue
+import numpy as np
+import cPickle
+import shutil
+import time
+import sys
+import os
+
+_pd = None  # centroids and labels of a worker process
+_rp = None
+
+
+def _init_worker():
+    global _pd, _rp
+    _pd = PDist()
+    _rp = Repr()
+
+
+def _site_images(ws, temp_dir):
+    """Normalizes images of a website into lossless files in temp_dir.
+    """
+    img_files = []
+    for root, dirs, fnames in os.walk(os.path.join(cf._raw_dir, ws[0])):
+        for f in sorted(fnames):
+            raw = open(os.path.join(root, f), 'rb').read()
+            if len(raw) < cf._min_size:
+                continue
+            try:
+                img_obj, _ = _decode(raw, cf._fast_resize)
+            except:
+                continue  # not a valid image
+            img_file = os.path.join(temp_dir, "img%06d.ppm" % len(img_files))
+            img_obj.save(img_file, 'PPM')
+            img_files.append(img_file)
+    return img_files
+
+
+def _process_site(ws):
+    """Representations of all images of a website, in a worker process.
+
+    Returns (url, class, representations), or (url, class, error message).
+    """
+    try:
+        temp_dir = os.path.join(cf._temp_dir, "stream%d" % os.getpid())
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)  # leftovers of a previous website
+        os.makedirs(temp_dir)
+        img_files = _site_images(ws, temp_dir)
+        results = []
+        if len(img_files) > 0:
+            results = csift_batch(img_files, "stream%d" % os.getpid())
+        shutil.rmtree(temp_dir)
+
+        # nearest centroids of all descriptors, in batches
+        count = np.array([len(r["descriptors"]) for r in results], dtype=np.int64)
+        count = count[count > 0]
+        if len(count) == 0:
+            return ws[1], ws[2], np.zeros((0, 2*cf._maxc))
+        D = np.vstack([r["descriptors"] for r in results
+                       if len(r["descriptors"]) > 0])
+        c = []
+        for i in xrange(0, D.shape[0], cf._nn_batch):
+            c.append(_pd.get_1nn(D[i:i+cf._nn_batch])[0])
+        first = np.hstack(([0], np.cumsum(count)[:-1]))
+        return ws[1], ws[2], _rp._repr_bulk(np.hstack(c), first, count)
+    except Exception as e:
+        return ws[1], ws[2], "Error in %s: %s" % (ws[0], e)
+
+
+def _read_ws(ws_file):
+    """Yields website descriptions from a file, one by one.
+    """
+    for line in open(ws_file, "r"):
+        if line.strip() != "":
+            yield line.strip().split(";")
+
+
+def _wait_site(done, pending):
+    """Waits for the next finished website, returns its task number and result.
+
+    A website of a worker process which has died never finishes, so
+    a website without result after "_stream_timeout" seconds is given up,
+    with None as result. Late results of given up websites are dropped.
+    """
+    while True:
+        try:
+            i, res = done.get(timeout=1)
+        except Queue.Empty:
+            now = time.time()
+            for i, (_, start) in pending.items():
+                if now - start > cf._stream_timeout:
+                    return i, None
+            continue
+        if i in pending:
+            return i, res
+
+
+def stream_sites(websites):
+    """Classifies websites, yields (url, true class, predicted class, outputs).
+
+    Results come in the order websites are finished. Predicted class
+    is -1 for websites without usable images, outputs is an error message
+    if a website failed.
+    """
+    elm = ELM()
+    param = cPickle.load(open(cf._elm_param, "rb"))
+    elm.set_param(param)
+    xm = param["xm"]
+    xs = param["xs"]
+
+    pool = Pool(cf._nr_wrk, initializer=_init_worker)
+    done = Queue.Queue()  # filled by pool callbacks, from another thread
+    pending = {}  # task number: (website, start time)
+    given_up = False
+    websites = iter(websites)
+    more = True
+    n = 0
+    while more or (len(pending) > 0):
+        # keeping "_stream_depth" websites in progress
+        while more and (len(pending) < cf._stream_depth):
+            try:
+                ws = websites.next()
+            except StopIteration:
+                more = False
+                break
+            pool.apply_async(_process_site, (ws,),
+                             callback=lambda res, i=n: done.put((i, res)))
+            pending[n] = (ws, time.time())
+            n += 1
+        if len(pending) == 0:
+            break
+        i, res = _wait_site(done, pending)
+        ws = pending.pop(i)[0]
+        if res is None:
+            given_up = True
+            res = ws[1], ws[2], ("Error in %s: no result in %d seconds"
+                                 % (ws[0], cf._stream_timeout))
+        url, cl, R = res
+        if isinstance(R, str):
+            yield url, cl, -1, R
+            continue
+        if R.shape[0] == 0:
+            yield url, cl, -1, np.zeros((cf._maxc,))
+            continue
+        Yh = elm.run((R - xm) / xs)
+        res = np.sum(Yh, 0)  # same as "save_res" for one website
+        yield url, cl, np.argmax(res), res
+    if given_up:
+        pool.terminate()  # given up websites may still hold their workers
+    else:
+        pool.close()
+    pool.join()
+
+
+def run_stream(ws_file):
+    if (cf._C_dir != "") and os.path.isfile(cf._C_file) and (not has_store()):
+        convert_centroids()  # workers memory-map centroids from there
+    f = open(cf._f_out, "w")
+    for url, cl, pred, res in stream_sites(_read_ws(ws_file)):
+        if isinstance(res, str):
+            sys.stderr.write(res + "\n")  # failed website, not a result
+            continue
+        line = "%s;%d;%s\n" % (url, pred, str(res))
+        f.write(line)
+        f.flush()  # results are available right away
+        if cf._show_progress:
+            print line,
+    f.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_stream(sys.argv[1])
+    else:
+        run_stream(cf._ws_descr)
@@ -6,43 +6,63 @@ Created on Wed Jun 26 15:30:16 2013
 """
 
 from ibc_config import IBCConfig as cf
+from modules.hdf5_creator import url_index
+from modules.demo_store import DemoStore
+from modules.grouping import factorize, group_sum
 from tables import openFile
 from elm.elm import ELM
+from numpy.lib.format import open_memmap
 import cPickle
 import numpy as np
+import os
 
 
 
-def get_data():
-    """Automatically select between HDF5 and img_data.pkl.
+def _array(name, shape):
+    """Array in RAM, or memory-mapped .npy file in "_data_mmap" folder.
+    """
+    if cf._data_mmap == "":
+        return np.empty(shape)
+    if not os.path.isdir(cf._data_mmap):
+        os.mkdir(cf._data_mmap)
+    return open_memmap(os.path.join(cf._data_mmap, name + ".npy"), "w+",
+                       np.float64, shape)
+
+
+def get_data(batch=100000):
+    """Automatically select between HDF5 and demo store.
+
+    In HDF5 mode, columns of Images are read in chunks of "batch" rows.
     """
     if cf._mode == "hdf5":
         db = openFile(cf._hdf5, "r")
         Images = db.root.Images
         Websites = db.root.Websites
         n = Images.nrows
-        X = np.empty((n, 2*cf._maxc))
-        Y = np.zeros((n, cf._maxc)) - 1
-        I = []
-        i = 0
+        X = _array("X", (n, 2*cf._maxc))
+        Y = _array("Y", (n, cf._maxc))
+        Y[:] = -1
         # getting translation table for ws_index: url
-        nw = Websites.nrows
-        urls = {}
-        for item in Websites.read(0, nw):
-            urls[item[0]] = item[7]
+        ws_index = url_index(Websites)
+        urls = np.empty((max(ws_index.values() + [-1]) + 1,),
+                        dtype=Websites.coldtypes["url"])
+        urls[ws_index.values()] = ws_index.keys()
+        I = np.empty((n,), dtype=urls.dtype)
         # gathering data
-        for row in Images.iterrows():
-            X[i,:] = row["img_repr"]
-            Y[i, row["classN"]] = 1
-            I.append(urls[row["site_index"]])
-            i += 1
+        for i in xrange(0, n, batch):
+            j = min(i + batch, n)
+            X[i:j] = Images.read(i, j, field="img_repr")
+            classN = Images.read(i, j, field="classN")
+            Y[np.arange(i, j), classN] = 1
+            I[i:j] = urls[Images.read(i, j, field="site_index")]
         db.close()
         return X,Y,I
     else:
         # assume that true class is unknown in demo mode
-        D = cPickle.load(open(cf._img_data, "rb"))
-        X = np.array([d[1] for d in D])
-        WS = [d[0] for d in D]
+        store = DemoStore()
+        images = store.load_images()  # (file name, url, raw file)
+        X = np.array(store.read("img_repr"))
+        WS = [images[i][1] for i in store.read("repr_img")]
         return X,[],WS
                 
 
@@ -103,11 +123,8 @@ def save_res(Yh, I):
     """Save results to HDF5 or formatted text document.
     """
     # determining results for websites
-    wslist = list(set(I))
-    res = np.zeros((len(wslist), Yh.shape[1]))
-    for i in xrange(len(Yh)):
-        idx = wslist.index(I[i])
-        res[idx,:] += Yh[i,:]        
+    wslist, groups = factorize(I)
+    res = group_sum(groups, Yh, len(wslist))
         
     f = open(cf._f_out, "w")
     for i in xrange(len(wslist)):
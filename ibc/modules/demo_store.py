@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Columnar storage of demo mode data, in place of a growing pickled list.
+
+Each column (like "regions", "descriptors", "neighbours") is a folder in
+"_demo_store" with .npy segments named "<start>_<stop>.npy" by the rows
+they hold. Data is only appended as new segments, never rewritten, and
+segments are memory-mapped on reading. "empty.npy" keeps the dtype and row
+shape of a column. A list of images with their websites is kept
+separately in "images.pkl".
+"""
+
+from ibc_config import IBCConfig as cf
+from modules.work_ranges import runs, merge
+import numpy as np
+import cPickle
+import shutil
+import os
+
+
+class DemoStore(object):
+    """Appends and reads columns of demo mode data.
+    """
+
+    def __init__(self):
+        self.dir = cf._demo_store
+        if not os.path.isdir(self.dir):
+            os.mkdir(self.dir)
+        self.segs = {}  # segments by column, listed once
+
+
+    def _col_dir(self, column):
+        return os.path.join(self.dir, column)
+
+
+    def save_images(self, images):
+        """Stores a list of (file name, url, raw file) of images, by number.
+        """
+        cPickle.dump(images, open(os.path.join(self.dir, "images.pkl"), "wb"), -1)
+
+
+    def load_images(self):
+        return cPickle.load(open(os.path.join(self.dir, "images.pkl"), "rb"))
+
+
+    def drop(self, *columns):
+        """Removes columns, to compute them again.
+        """
+        for column in columns:
+            shutil.rmtree(self._col_dir(column), True)
+            self.segs.pop(column, None)
+
+
+    def segments(self, column):
+        """Sorted list of (start, stop, file name) of column segments.
+        """
+        if column in self.segs:
+            return self.segs[column]
+        d = self._col_dir(column)
+        segs = []
+        if os.path.isdir(d):
+            for f in os.listdir(d):
+                if f.endswith(".npy") and (f != "empty.npy"):
+                    start, stop = f[:-4].split("_")
+                    segs.append((int(start), int(stop), os.path.join(d, f)))
+        segs.sort()
+        self.segs[column] = segs
+        return segs
+
+
+    def ranges(self, column):
+        """Merged (n, 2) array of [start, stop) rows present in a column.
+        """
+        return merge([s[:2] for s in self.segments(column)])
+
+
+    def nrows(self, column):
+        segs = self.segments(column)
+        if len(segs) == 0:
+            return 0
+        return max(s[1] for s in segs)
+
+
+    def empty(self, column):
+        """Array of zero rows with dtype and shape of a column.
+
+        Columns without data have no known shape, they give (0,) floats.
+        """
+        fname = os.path.join(self._col_dir(column), "empty.npy")
+        if not os.path.isfile(fname):
+            return np.zeros((0,))
+        return np.load(fname)
+
+
+    def append(self, column, data, start=None):
+        """Writes rows of a column from "start", by default after the last one.
+        """
+        if start is None:
+            start = self.nrows(column)
+        data = np.asarray(data)
+        d = self._col_dir(column)
+        if not os.path.isdir(d):
+            os.mkdir(d)
+            np.save(os.path.join(d, "empty.npy"), data[:0])
+        fname = os.path.join(d, "%012d_%012d.npy" % (start, start + len(data)))
+        temp = fname + ".tmp"  # readers never see half of a segment
+        f = open(temp, "wb")
+        np.save(f, data)
+        f.close()
+        os.rename(temp, fname)
+        segs = self.segments(column)
+        segs.append((start, start + len(data), fname))
+        segs.sort()
+        return start
+
+
+    def append_rows(self, column, index, data):
+        """Writes rows with given indices, one segment for each run of them.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        order = np.argsort(index, kind="mergesort")
+        index = index[order]
+        data = np.asarray(data)[order]
+        i = 0
+        for start, stop in runs(index):
+            self.append(column, data[i:i+stop-start], start)
+            i += stop - start
+
+
+    def read(self, column, start=0, stop=None):
+        """Rows of a column from start to stop-1.
+
+        Data is memory-mapped if it is in one segment, copied otherwise.
+        Raises IndexError if some of the rows have not been written.
+        """
+        segs = self.segments(column)
+        if stop is None:
+            stop = self.nrows(column)
+        parts = []
+        pos = start  # first row not found yet
+        for s0, s1, fname in segs:
+            if (s1 <= pos) or (pos >= stop):
+                continue
+            if s0 > pos:
+                break
+            data = np.load(fname, mmap_mode="r")
+            parts.append(data[pos - s0 : min(stop, s1) - s0])
+            pos = min(stop, s1)
+        if pos < stop:
+            raise IndexError("No rows %d-%d in column '%s' of demo store"
+                             % (pos, stop - 1, column))
+        if len(parts) == 0:
+            return self.empty(column)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+
+    def take(self, column, idx):
+        """Rows of a column with the given indices, read by consecutive runs.
+        """
+        parts = [self.read(column, start, stop) for start, stop in runs(idx)]
+        if len(parts) == 0:
+            return self.empty(column)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of image descriptors, keyed by SHA1 of an original image.
+
+Same images (banners, logos, site design) repeat a lot between websites.
+Regions and descriptors of an image are stored once, in a separate .npz file
+"_descr_cache/<sha1[:2]>/<sha1>.npz", and reused for all its copies. They
+keep a signature of preprocessing and extraction settings, and are ignored
+if these have changed. Nearest neighbours are stored too, together with
+a signature of centroids they were computed with; they are ignored if
+centroids have changed, or if some of them are missing (-1).
+"""
+
+from ibc_config import IBCConfig as cf
+import numpy as np
+import os
+
+
+def _descr_signature():
+    """Identifies settings which change regions and descriptors of an image.
+    """
+    quality = cf._jpeg_quality
+    if cf._img_handoff == "shm":
+        quality = -1  # extraction reads lossless images
+    return "%s;%d;%d;%d;%s;%d" % (cf._descr_extractor, cf._max_dim,
+                                  cf._fast_resize, quality,
+                                  cf._img_handoff, cf._max_reg)
+
+
+def _nn_signature():
+    """Identifies centroids and neighbours settings, None without centroids.
+    """
+    if not os.path.isfile(cf._C_file):
+        return None
+    st = os.stat(cf._C_file)
+    return "%d;%d;%d;%s;%s;%s;%d;%d" % (st.st_size, st.st_mtime, cf._nn_count,
+                                        cf._nn_index, cf._nn_engine,
+                                        cf._nn_dtype, cf._ivf_lists,
+                                        cf._ivf_probe)
+
+
+class DescrCache(object):
+    """Stores and returns "csift" results by image SHA1.
+    """
+
+    def __init__(self):
+        self.dir = cf._descr_cache
+        if not os.path.isdir(self.dir):
+            os.mkdir(self.dir)
+        self.descr_sig = _descr_signature()
+        self._nn_sig = False  # not known yet
+
+
+    @property
+    def nn_sig(self):
+        """Signature of neighbours, found when they are first needed.
+
+        Descriptors are often computed before centroids exist.
+        """
+        if self._nn_sig is False:
+            self._nn_sig = _nn_signature()
+        return self._nn_sig
+
+
+    def _path(self, sha1):
+        return os.path.join(self.dir, sha1[:2], sha1 + ".npz")
+
+
+    def _save(self, sha1, arrays):
+        """Writes a file atomically, so that readers never see half of it.
+        """
+        path = self._path(sha1)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.mkdir(os.path.dirname(path))
+            except OSError:  # created by another process
+                pass
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        np.savez(open(temp, "wb"), **arrays)
+        os.rename(temp, path)
+
+
+    def get(self, sha1, neighbours=True):
+        """Returns cached data of an image, or None.
+
+        Data has "regions" and "descriptors" like a "csift" result, and
+        "neighbours" array of (n, _nn_count, 2) if they are valid and asked.
+        """
+        path = self._path(sha1)
+        if not os.path.isfile(path):
+            return None
+        npz = np.load(path)
+        if ("descr_sig" not in npz.files) or\
+                (str(npz["descr_sig"]) != self.descr_sig):
+            return None  # made with other settings
+        data = {}
+        data["regions"] = npz["regions"]
+        data["descriptors"] = npz["descriptors"]
+        if neighbours and ("neighbours" in npz.files) and\
+                (str(npz["nn_sig"]) == self.nn_sig):
+            ngb = npz["neighbours"]
+            if (len(ngb) == 0) or np.all(ngb[:, 0, 0] != -1):
+                data["neighbours"] = ngb
+        return data
+
+
+    def put(self, sha1, data):
+        """Stores "csift" result of an image.
+        """
+        self._save(sha1, {"regions": data["regions"],
+                          "descriptors": data["descriptors"],
+                          "descr_sig": np.array(self.descr_sig)})
+
+
+    def put_neighbours(self, sha1, neighbours):
+        """Adds nearest neighbours to a cached image.
+        """
+        data = self.get(sha1, neighbours=False)
+        if (data is None) or (self.nn_sig is None):
+            return
+        self._save(sha1, {"regions": data["regions"],
+                          "descriptors": data["descriptors"],
+                          "descr_sig": np.array(self.descr_sig),
+                          "neighbours": neighbours,
+                          "nn_sig": np.array(self.nn_sig)})
@@ -7,10 +7,13 @@ If something goes wrong, returns string describing the error.
 
 from ibc_config import IBCConfig as cf
 from mp.mp_master import MPMaster
+from modules.descr_cache import DescrCache
+from modules.hdf5_creator import DescriptorStore, empty_rows
+from modules.work_ranges import pending, add_done, runs
+from modules.demo_store import DemoStore
 from tables import openFile
 import numpy as np
 import cPickle
-import os
 
 
 class Master(MPMaster):
@@ -26,19 +29,55 @@ class Master(MPMaster):
             self.hdf5 = openFile(cf._hdf5, "a")
             self.Images = self.hdf5.root.Images
             self.Regions = self.hdf5.root.Regions        
-            self.Descriptors = self.hdf5.root.Descriptors
+            self.Descriptors = DescriptorStore(self.hdf5)
             self.reg_last = self.Regions.attrs.last_index        
-            self.des_last = self.Descriptors.attrs.last_index
+            self.des_last = self.Descriptors.last_index
+            self.reg_buf = []  # new rows, appended in groups
+            self.des_buf = []
+            self.cls_buf = []
+            self.buf_rows = 0
+            self.img_rows = []  # (index, reg_count, reg_first) of images
+            self.img_done = []  # images and regions written since last flush
+            self.nn_done = []
             # gathering a list of tasks
-            for row in self.Images.where("reg_count == -1"):
-                self.tasks.append((row["index"], row["file_name"]))
+            self.sha1 = {}
+            self.img_info = {}  # class and website of an image
+            todo = pending(self.Images, "descr_done", self._descr_finished)
+            for start, stop in runs(todo):
+                for row in self.Images.iterrows(start, stop):
+                    if row["reg_count"] != -1:  # done, but not marked yet
+                        continue
+                    if cf._img_handoff == "shm":
+                        self.tasks.append((row["index"], (row["true_name"],
+                                                          row["file_name"])))
+                    else:
+                        self.tasks.append((row["index"], row["file_name"]))
+                    self.sha1[row["index"]] = row["orig_sha1"]
+                    self.img_info[row["index"]] = (row["classN"],
+                                                   row["site_index"])
+            self.cache = None
+            if cf._descr_cache != "":
+                self.cache = DescrCache()
+                self._use_cache()
         else:
-            self.img_data = []
+            self.store = DemoStore()
+            self.store.drop("img", "regions", "descriptors", "neighbours",
+                            "repr_img", "img_repr")
+            # (file name, url, raw file) of images, numbers are their index
             imglist = cPickle.load(open(cf._img_data, "rb"))
-            for item in imglist:
-                # here using ("url", "filename") instead of "index" in hdf5,
-                # because we need both filename and url later on
-                self.tasks.append(((item[1], item[0]), item[0]))       
+            self.store.save_images(imglist)
+            self.img_buf = []  # new rows, appended in groups
+            self.reg_buf = []
+            self.des_buf = []
+            self.buf_rows = 0
+            for idx, item in enumerate(imglist):
+                if cf._img_handoff == "shm":
+                    self.tasks.append((idx, (item[2], item[0])))
+                else:
+                    self.tasks.append((idx, item[0]))
+
+        # "shm" tasks are original images, always sent in batches
+        self.batched = (cf._descr_batch > 1) or (cf._img_handoff == "shm")
         
         # initializing reporting part
         self.task_max = len(self.tasks)
@@ -48,80 +87,213 @@ class Master(MPMaster):
     def __del__(self):
         if cf._mode == "hdf5":
             self.hdf5.close()
+
+
+    def _descr_finished(self, start, stop):
+        """Images having descriptors, for files without "descr_done".
+        """
+        return self.Images.read(start, stop, field="reg_count") != -1
+
+
+    def _use_cache(self):
+        """Writes cached images, and leaves only one task for each SHA1.
+
+        Copies of an image are written when its result arrives.
+        """
+        tasks = []
+        self.dups = {}  # image indices waiting for a result, by SHA1
+        for idx, img_file in self.tasks:
+            sha1 = self.sha1[idx]
+            if sha1 == "":  # unknown hash, not cached
+                tasks.append((idx, img_file))
+                continue
+            if sha1 in self.dups:
+                self.dups[sha1].append(idx)
+                continue
+            data = self.cache.get(sha1)
+            if data is not None:
+                self._process_result_hdf5((data, idx), False)
+            else:
+                self.dups[sha1] = []
+                tasks.append((idx, img_file))
+        if cf._show_progress:
+            print "%d images found in descriptors cache" % (len(self.tasks) -
+                                                            len(tasks))
+        self.tasks = tasks
+        self._write_rows()
+
+
+    def _cache_result(self, result, flush):
+        """Stores new result in cache, and writes it to all image copies.
+        """
+        data, idx = result
+        sha1 = self.sha1[idx]
+        if sha1 == "":
+            return
+        self.cache.put(sha1, data)
+        for dup in self.dups.pop(sha1, []):
+            self._process_result_hdf5((data, dup), flush)
             
         
     def get_new_task(self):
         # just yielding tasks here
-        for idx, img_file in self.tasks:
-            yield ("csift", img_file, idx)
+        if self.batched:
+            # several images per extractor run
+            task = "csift_raw" if cf._img_handoff == "shm" else "csift_batch"
+            size = max(cf._descr_batch, 1)
+            for i in xrange(0, len(self.tasks), size):
+                batch = self.tasks[i:i+size]
+                yield (task, [t[1] for t in batch], [t[0] for t in batch])
+        else:
+            for idx, img_file in self.tasks:
+                yield ("csift", img_file, idx)
 
     
+    def _write_store(self):
+        """Appends buffered data to demo store, as one segment per column.
+        """
+        if self.buf_rows > 0:
+            self.store.append("img", np.concatenate(self.img_buf))
+            self.store.append("regions", np.concatenate(self.reg_buf))
+            self.store.append("descriptors", np.concatenate(self.des_buf))
+            self.img_buf = []
+            self.reg_buf = []
+            self.des_buf = []
+            self.buf_rows = 0
+
+
     def _process_result(self, result, flush):
-        """Demo mode, save output as is.
+        """Demo mode, append output to demo store.
+
+        Regions of an image are stored consecutively, with its number
+        in "img" column.
         """
-        data, (url, filename) = result
-        for i in xrange(len(data["regions"])):
-            r = data["regions"][i]
-            r.append(url)  # hide url in parameters list
-            d = data["descriptors"][i]
-            self.img_data.append([filename, r, d])
-
-        if flush:
-            cPickle.dump(self.img_data, open(cf._img_data, "wb"), -1)     
+        data, idx = result
+        nregs = len(data["regions"])
+        if nregs > 0:
+            self.img_buf.append(np.ones((nregs,), dtype=np.int64) * idx)
+            self.reg_buf.append(data["regions"])
+            self.des_buf.append(data["descriptors"])
+            self.buf_rows += nregs
+        if self.buf_rows >= cf._write_batch:
+            self._write_store()
     
     
+    def _write_images(self):
+        """Writes buffered region counts of images, by runs of indices.
+        """
+        if len(self.img_rows) == 0:
+            return
+        img = np.array(self.img_rows, dtype=np.int64)
+        img = img[np.argsort(img[:, 0], kind="mergesort")]
+        pos = 0
+        for start, stop in runs(img[:, 0]):
+            part = img[pos:pos + stop - start]
+            self.Images.modify_columns(start, stop,
+                                       columns=[part[:, 1], part[:, 2]],
+                                       names=["reg_count", "reg_first"])
+            pos += stop - start
+        self.img_rows = []
+
+
+    def _write_rows(self):
+        """Appends buffered regions and descriptors, flushes all tables.
+        """
+        self._write_images()
+        if self.buf_rows > 0:
+            self.Regions.append(np.concatenate(self.reg_buf))
+            self.Descriptors.append(np.concatenate(self.cls_buf),
+                                    np.concatenate(self.des_buf))
+            self.reg_buf = []
+            self.des_buf = []
+            self.cls_buf = []
+            self.buf_rows = 0
+        self.Regions.attrs.last_index = self.reg_last
+        self.Descriptors.last_index = self.des_last
+        self.Images.flush()
+        self.Regions.flush()
+        self.Descriptors.flush()
+        # ranges are marked finished only after their data is saved
+        if len(self.img_done) > 0:
+            add_done(self.Images, "descr_done", runs(sorted(self.img_done)))
+            self.img_done = []
+        if len(self.nn_done) > 0:
+            add_done(self.Regions, "nn_done", runs(np.hstack(self.nn_done)))
+            self.nn_done = []
+
+
     def _process_result_hdf5(self, result, flush):
         """Batch mode, write output to HDF5 file.
+
+        Regions and descriptors of an image are built as arrays, and
+        appended to tables in groups of "_write_batch" rows; image records
+        are updated at the same time.
         """
         data, idx = result
+        classN, site_index = self.img_info[idx]
 
-        # updating image record
+        # updating image record, written together with regions
         nregs = len(data["regions"])
-        for irow in self.Images.iterrows(idx, idx+1):
-            irow["reg_count"] = nregs        
-            if nregs > 0:
-                irow["reg_first"] = self.reg_last + 1
-            irow.update()
-                                      
-        # writing regions and descriptors            
-        for i in xrange(len(data["regions"])):
-            rrow = self.Regions.row
-            rrow["index"] = self.reg_last + i + 1
-            rrow["img_class"] = irow["classN"]
-            rrow["img_site"] = irow["site_index"]
-            rrow["img_index"] = idx
-            rrow["center"] = data["regions"][i][1]            
-            rrow["radius"] = data["regions"][i][2]            
-            rrow["cornerness"] = data["regions"][i][3]            
-            rrow.append()
-            
-            drow = self.Descriptors.row
-            drow["index"] = self.des_last + i + 1
-            drow["classN"] = irow["classN"]
-            drow["data"] = data["descriptors"][i]
-            drow.append()
+        if nregs > 0:
+            self.img_rows.append((idx, nregs, self.reg_last + 1))
+        else:
+            self.img_rows.append((idx, nregs, -1))
+
+        # preparing regions and descriptors
+        if nregs > 0:
+            regions = data["regions"]
+            reg = empty_rows(self.Regions, nregs)
+            reg["index"] = np.arange(self.reg_last + 1, self.reg_last + nregs + 1)
+            reg["img_class"] = classN
+            reg["img_site"] = site_index
+            reg["img_index"] = idx
+            reg["center"] = regions["center"]
+            reg["radius"] = regions["radius"]
+            reg["cornerness"] = regions["cornerness"]
+            if "neighbours" in data:  # from cache
+                reg["neighbours"] = data["neighbours"]
+                self.nn_done.append(reg["index"])
+            self.reg_buf.append(reg)
+
+            self.des_buf.append(data["descriptors"])
+            self.cls_buf.append(np.ones((nregs,), dtype=np.int8) * classN)
+            self.buf_rows += nregs
         
         # updating parameters
+        self.img_done.append(idx)
         self.reg_last += nregs
         self.des_last += nregs
         
         # writing data
-        self.Regions.attrs.last_index = self.reg_last
-        self.Descriptors.attrs.last_index = self.des_last
-        if flush:
-            self.Images.flush()
-            self.Regions.flush()
-            self.Descriptors.flush()
+        if flush or (self.buf_rows >= cf._write_batch):
+            self._write_rows()
     
     
     def process_result(self, result, flush):
-        """Choose between batch and demo mode.        
+        """Choose between batch and demo mode.
+
+        Results of batch tasks are split into separate images.
         """
-        self.task_curr -= 1
+        if self.batched:
+            results = zip(*result)
+        else:
+            results = [result]
+        for i in xrange(len(results)):
+            self.task_curr -= 1
+            last = flush and (i == len(results) - 1)
+            if cf._mode == "hdf5":
+                self._process_result_hdf5(results[i], last)
+                if self.cache is not None:
+                    self._cache_result(results[i], last)
+            else:
+                self._process_result(results[i], last)
+
+
+    def finalize(self):
         if cf._mode == "hdf5":
-            self._process_result_hdf5(result, flush)
+            self._write_rows()
         else:
-            self._process_result(result, flush)
+            self._write_store()
         
         
 
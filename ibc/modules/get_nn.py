@@ -7,9 +7,13 @@ If something goes wrong, returns string describing the error.
 
 from ibc_config import IBCConfig as cf
 from mp.mp_master import MPMaster
+from modules.descr_cache import DescrCache
+from modules.hdf5_creator import DescriptorStore
+from modules.work_ranges import pending, add_done, runs, gaps
+from modules.demo_store import DemoStore
+from modules.img_repr import _write_repr
 from tables import openFile
 import numpy as np
-import cPickle
 import os
 
 
@@ -24,79 +28,232 @@ class Master(MPMaster):
         # preparing for job generation
         if cf._mode == "hdf5":
             self.hdf5 = openFile(cf._hdf5, "a")
+            self.Images = self.hdf5.root.Images
             self.Regions = self.hdf5.root.Regions        
-            self.Descriptors = self.hdf5.root.Descriptors
+            self.Descriptors = DescriptorStore(self.hdf5)
+            self.done = []  # regions or images written since the last flush
             # gathering a list of tasks
-            for row in self.Regions.iterrows():
-                if row["neighbours"][0,0] == -1:
-                    self.tasks.append(row["index"])
+            if cf._nn_store:
+                self.tasks = pending(self.Regions, "nn_done",
+                                     self._nn_finished)
         else:
-            self.img_data = cPickle.load(open(cf._img_data, "rb"))
-            self.tasks = range(len(self.img_data))
+            self.store = DemoStore()
+            self.buf = []  # (row indices, data) written in groups
+            self.buf_rows = 0
+            # descriptors which have no neighbours segments yet
+            if cf._nn_store:
+                self.tasks = gaps(self.store.ranges("neighbours"),
+                                  self.store.nrows("descriptors"))
         
         # initializing reporting part
-        self.task_max = len(self.tasks)/cf._nn_batch + 1
+        if cf._nn_store:
+            self.task_max = (len(self.tasks) + cf._nn_batch - 1) / cf._nn_batch
+        else:
+            self._init_repr_tasks()
+            self.task_max = len(self.tasks)
         self.task_curr = self.task_max
 
 
+    def _init_repr_tasks(self):
+        """Tasks of workers computing image representations by themselves.
+
+        Images having descriptors are sorted by their first region, and
+        grouped into tasks of about "_nn_batch" descriptors; a task is
+        a slice of these images.
+        """
+        if cf._mode == "hdf5":
+            todo = pending(self.Images, "repr_done", self._repr_finished)
+            rows = self.Images.read_coordinates(todo)
+            rows = rows[rows["reg_count"] != -1]  # no descriptors yet
+            index = rows["index"]
+            first = rows["reg_first"]
+            count = rows["reg_count"]
+            empty = (count == 0)
+            if np.any(empty):
+                R = np.zeros((np.sum(empty), 2*cf._maxc), dtype=np.float64)
+                _write_repr(self.Images, index[empty], R)
+                self.done.append(index[empty])
+                self._flush()
+            index = index[~empty]
+            first = first[~empty]
+            count = count[~empty]
+        else:
+            self.store.drop("repr_img", "img_repr")
+            index, first, count = np.unique(self.store.read("img"),
+                                            return_index=True,
+                                            return_counts=True)
+        order = np.argsort(first, kind="mergesort")
+        self.img_index = index[order]
+        self.img_first = first[order]
+        self.img_count = count[order]
+
+        n = len(self.img_index)
+        group = (np.cumsum(self.img_count) - self.img_count) / cf._nn_batch
+        starts = np.hstack(([0], np.where(np.diff(group) > 0)[0] + 1))
+        ends = np.hstack((starts[1:], [n]))
+        self.tasks = zip(starts, ends) if n > 0 else []
+
+
+    def _repr_finished(self, start, stop):
+        """Images having representations, for files without "repr_done".
+        """
+        return self.Images.read(start, stop, field="img_repr")[:, 0] != -1
+
+
     def __del__(self):
         if cf._mode == "hdf5":
             self.hdf5.close()
             
     
+    def _nn_finished(self, start, stop):
+        """Regions having neighbours, for files without "nn_done".
+        """
+        ngb = self.Regions.read(start, stop, field="neighbours")
+        return ngb[:, 0, 0] != -1
+
+
+    def _flush(self):
+        if cf._nn_store:
+            self.Regions.flush()
+            if len(self.done) > 0:
+                add_done(self.Regions, "nn_done", runs(np.hstack(self.done)))
+        else:
+            self.Images.flush()
+            if len(self.done) > 0:
+                done = np.sort(np.hstack(self.done))
+                add_done(self.Images, "repr_done", runs(done))
+        self.done = []
+
+
     def _get_descr(self, batch):
         descrs = []
         if cf._mode == "hdf5":
-            descrs = self.Descriptors.read_coordinates(batch, field="data")
+            descrs = self.Descriptors.read(batch)
         else:
-            descrs = np.array([self.img_data[b][2] for b in batch])
+            descrs = np.asarray(self.store.take("descriptors", batch))
         return descrs
         
         
     def get_new_task(self):
         # just yielding tasks here
-        batch = []
-        for idx in self.tasks:
-            batch.append(idx)
-            if len(batch) >= cf._nn_batch:
-                yield ("nn", self._get_descr(batch), batch)
-                batch = []
-        # final batch
-        yield ("nn", self._get_descr(batch), batch)
+        if not cf._nn_store:
+            for i, j in self.tasks:
+                first = self.img_first[i:j]
+                count = self.img_count[i:j]
+                regions = np.hstack([np.arange(f, f + c)
+                                     for f, c in zip(first, count)])
+                yield ("nn_repr", self._get_descr(regions),
+                       (i, self.img_index[i:j]), count)
+            return
+        for i in xrange(0, len(self.tasks), cf._nn_batch):
+            batch = self.tasks[i:i+cf._nn_batch]
+            yield ("nn", self._get_descr(batch), batch)
 
     
+    def _write_store(self):
+        """Demo mode, appends buffered results with one segment per run.
+        """
+        if len(self.buf) == 0:
+            return
+        index = np.hstack([b[0] for b in self.buf])
+        data = [np.concatenate([b[i] for b in self.buf])
+                for i in xrange(1, len(self.buf[0]))]
+        if cf._nn_store:
+            self.store.append_rows("neighbours", index, data[0])
+        else:
+            self.store.append_rows("repr_img", index, data[0])
+            self.store.append_rows("img_repr", index, data[1])
+        self.buf = []
+        self.buf_rows = 0
+
+
     def _process_result(self, result, flush):
-        """Demo mode, save output as is.
+        """Demo mode, append neighbours of a batch to demo store.
+
+        Results are written in groups of "_write_batch" rows, because
+        batches come in any order and are smaller than segments should be.
         """
         (idx, dist), batch = result
-        # save obtained neighbourhood parameters of each descriptor
-        for b in range(len(batch)):
-            self.img_data[batch[b]].append((idx[b,:], dist[b,:]))
-        
-        if flush:
-            cPickle.dump(self.img_data, open(cf._img_data, "wb"), -1)     
+        data = np.dstack((idx, dist)).astype(np.float64)  # (n, k, 2)
+        self.buf.append((batch, data))
+        self.buf_rows += len(batch)
+        if self.buf_rows >= cf._write_batch:
+            self._write_store()
     
     
     def _process_result_hdf5(self, result, flush):
         """Batch mode, write output to HDF5 file.
+
+        Neighbours are written with one call for each run of consecutive
+        regions in a batch, usually one call for the whole batch.
         """
         (inds, dist), batch = result
+        data = np.dstack((inds, dist)).astype(np.float64)  # (n, k, 2)
         # updating regions records
-        for b in range(len(batch)):
-            data = np.vstack((inds[b,:], dist[b,:])).T
-            data.dtype = np.float64
-            self.Regions.modify_column(batch[b], batch[b]+1,
-                                       colname="neighbours", column=data)
+        i = 0
+        for start, stop in runs(batch):
+            n = stop - start
+            self.Regions.modify_column(start, stop, colname="neighbours",
+                                       column=data[i:i+n])
+            i += n
+        self.done.append(batch)
         # saving if necessary
         if flush:
-            self.Regions.flush()
+            self._flush()
     
     
+    def _process_repr(self, result, flush):
+        """Writes image representations computed by workers.
+
+        In demo mode, they are stored at positions of images among all
+        tasks, so that results can come in any order.
+        """
+        R, (i, images) = result
+        if cf._mode == "hdf5":
+            _write_repr(self.Images, images, R)
+            self.done.append(images)
+            if flush:
+                self._flush()
+        else:
+            self.buf.append((np.arange(i, i + len(images)), images, R))
+            self.buf_rows += len(images)
+            if self.buf_rows >= cf._write_batch:
+                self._write_store()
+
+
+    def _cache_neighbours(self):
+        """Adds neighbours of processed images to descriptors cache.
+
+        Images with some regions still without neighbours (a failed
+        batch) are not cached.
+        """
+        cache = DescrCache()
+        imgs = self.Regions.read_coordinates(self.tasks, field="img_index")
+        for img in self.Images.read_coordinates(np.unique(imgs)):
+            if (img["reg_count"] > 0) and (img["orig_sha1"] != ""):
+                i0 = img["reg_first"]
+                data = self.Regions.read(i0, i0 + img["reg_count"],
+                                         field="neighbours")
+                if np.all(data[:, 0, 0] != -1):
+                    cache.put_neighbours(img["orig_sha1"], data)
+
+
+    def finalize(self):
+        if cf._mode == "hdf5":
+            self._flush()
+            if cf._nn_store and (cf._descr_cache != ""):
+                self._cache_neighbours()
+        else:
+            self._write_store()
+
+
     def process_result(self, result, flush):
         """Choose between batch and demo mode.        
         """
         self.task_curr -= 1
-        if cf._mode == "hdf5":
+        if not cf._nn_store:
+            self._process_repr(result, flush)
+        elif cf._mode == "hdf5":
             self._process_result_hdf5(result, flush)
         else:
             self._process_result(result, flush)
@@ -105,7 +262,7 @@ class Master(MPMaster):
 
 def calc_nn(kill_workers):
     master = Master(kill_workers)
-    if master.tasks == []:
+    if len(master.tasks) == 0:
         print "No neighbours to calculate"
         # killing workers if needed
         if kill_workers:
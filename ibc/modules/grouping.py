@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Grouping of data rows by keys, in linear time.
+
+Keys (urls, image numbers) are factorized once into group numbers
+0..n-1, then values are summed per group with "np.bincount".
+"""
+
+import numpy as np
+
+
+def factorize(keys):
+    """Returns unique keys, and group number of each key among them.
+    """
+    return np.unique(np.asarray(keys), return_inverse=True)
+
+
+def group_count(groups, n):
+    """Number of rows in each of n groups.
+    """
+    return np.bincount(groups, minlength=n)
+
+
+def group_sum(groups, values, n):
+    """Sums rows of values in each of n groups.
+
+    Columns are summed one by one with "np.bincount", which is much faster
+    than "np.add.at" for few columns.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        return np.bincount(groups, weights=values, minlength=n)
+    result = np.empty((n, values.shape[1]), dtype=np.float64)
+    for j in xrange(values.shape[1]):
+        result[:, j] = np.bincount(groups, weights=values[:, j], minlength=n)
+    return result
@@ -7,10 +7,138 @@ Created on Thu Jun 20 14:07:34 2013
 
 from config.config_hdf5 import *
 from ibc_config import IBCConfig as cf
+from modules.work_ranges import runs, set_done
+from tables import Filters, UInt8Atom, Int8Atom
 from os.path import join
+import uuid
 import os
 
 
+def empty_rows(table, n):
+    """Array of n table rows with default values, to fill and append at once.
+    """
+    rows = np.empty((n,), dtype=table.dtype)
+    for name, dflt in table.coldflts.items():
+        rows[name] = dflt
+    return rows
+
+
+def url_index(Websites):
+    """Dictionary of website indices by url, read from Websites in one pass.
+    """
+    urls = Websites.col("url")
+    index = Websites.col("index")
+    return dict(zip(urls, index))
+
+
+def create_descr(db, layout):
+    """Creates empty storage for descriptors in an open HDF5 file.
+
+    "table" is a Descriptors table of DColorSIFTRecord. "earray" is a
+    compressed (N, 384) uint8 DescrData array with chunks of "_nn_batch"
+    rows, and a parallel DescrClass array with classes of descriptors.
+    """
+    if layout == "earray":
+        filters = Filters(complevel=5, complib=cf._descr_complib, shuffle=True)
+        data = db.createEArray(db.root, "DescrData", UInt8Atom(), (0, 384),
+                               filters=filters, chunkshape=(cf._nn_batch, 384))
+        data.attrs.last_index = -1
+        db.createEArray(db.root, "DescrClass", Int8Atom(), (0,),
+                        filters=filters, chunkshape=(cf._nn_batch * 384,))
+    else:
+        DsNew = db.createTable(db.root, 'Descriptors', DColorSIFTRecord)
+        DsNew.attrs.last_index = -1
+        DsNew.cols.index.createCSIndex()
+        DsNew.cols.classN.createCSIndex()
+        DsNew.autoIndex = True
+
+
+class DescriptorStore(object):
+    """Descriptors of an open HDF5 file, in either storage layout.
+
+    Layout is found from the file itself, so files created with any
+    "_descr_layout" can be read and appended to.
+    """
+
+    def __init__(self, db):
+        if "DescrData" in db.root:
+            self.layout = "earray"
+            self.data = db.root.DescrData
+            self.classN = db.root.DescrClass
+            self.node = self.data
+        else:
+            self.layout = "table"
+            self.table = db.root.Descriptors
+            self.node = self.table
+
+
+    @property
+    def nrows(self):
+        return self.node.nrows
+
+
+    def get_last_index(self):
+        return self.node.attrs.last_index
+
+    def set_last_index(self, value):
+        self.node.attrs.last_index = value
+
+    last_index = property(get_last_index, set_last_index)
+
+
+    def append(self, classN, data):
+        """Appends descriptors (n, 384) with their classes (n,).
+        """
+        n = len(data)
+        if n == 0:
+            return
+        if self.layout == "earray":
+            self.data.append(data)
+            self.classN.append(classN)
+        else:
+            rows = empty_rows(self.table, n)
+            rows["index"] = np.arange(self.table.nrows, self.table.nrows + n)
+            rows["classN"] = classN
+            rows["data"] = data
+            self.table.append(rows)
+
+
+    def read_range(self, start, stop):
+        """Descriptors with indices from start to stop-1.
+        """
+        if self.layout == "earray":
+            return self.data[start:stop]
+        return self.table.read(start, stop, field="data")
+
+
+    def read_class(self, start, stop):
+        """Classes of descriptors with indices from start to stop-1.
+        """
+        if self.layout == "earray":
+            return self.classN[start:stop]
+        return self.table.read(start, stop, field="classN")
+
+
+    def read(self, coords):
+        """Descriptors with the given indices.
+
+        Indices of a batch are mostly consecutive, so each run of
+        consecutive indices is read as one slice.
+        """
+        parts = [self.read_range(start, stop) for start, stop in runs(coords)]
+        if len(parts) == 0:
+            return np.zeros((0, 384), dtype=np.uint8)
+        if len(parts) == 1:
+            return parts[0]
+        return np.vstack(parts)
+
+
+    def flush(self):
+        self.node.flush()
+        if self.layout == "earray":
+            self.classN.flush()
+
+
 def create_empty_hdf5():
     """Builds an empty HDF5 file having the given tables.
     """    
@@ -22,35 +150,42 @@ def create_empty_hdf5():
 
     ImNew = dnew.createTable(dnew.root, "Images", ImagesRecord)
     ImNew.attrs.last_index = -1
+    ImNew.attrs.db_id = uuid.uuid4().hex  # manifest belongs to one database
     ImNew.attrs.nr_in_class = np.zeros((cf._maxc,))
+    set_done(ImNew, "descr_done", [])
+    set_done(ImNew, "repr_done", [])
     ImNew.cols.site_index.createCSIndex()
     ImNew.cols.index.createCSIndex()        
     
     RgNew = dnew.createTable(dnew.root, 'Regions', RegionsRecord)
     RgNew.attrs.last_index = -1
+    set_done(RgNew, "nn_done", [])
     RgNew.cols.img_index.createCSIndex()
         
-    DsNew = dnew.createTable(dnew.root, 'Descriptors', DColorSIFTRecord)
-    DsNew.attrs.last_index = -1
-    DsNew.cols.index.createCSIndex()
-    DsNew.cols.classN.createCSIndex()
-    DsNew.autoIndex = True  
+    create_descr(dnew, cf._descr_layout)
     
     dnew.close()
     
     
 def init_hdf5():
     """Fills websites into an empty HDF5.
+
+    With "_manifest", an existing HDF5 file is kept and only new websites
+    are added, so that old images are not processed again.
     """
     if cf._mode != "hdf5":
         return
-    create_empty_hdf5()
+    if (cf._manifest == "") or (not os.path.isfile(cf._hdf5)):
+        create_empty_hdf5()
 
     db = openFile(cf._hdf5, "a")    
     wdf = open(cf._ws_descr, "r")
     Websites = db.root.Websites
+    known = url_index(Websites)
     for ws in wdf:
         d1,url,cl = ws.split(";")
+        if url in known:
+            continue
         cl = int(cl)
         d1 = join(cf._raw_dir, d1)
         nfiles = 0
@@ -66,6 +201,7 @@ def init_hdf5():
         row['img_count'] = nfiles
         row.append()
         Websites.attrs.last_index = index
+        known[url] = index
     Websites.flush()    
     db.close()
     
@@ -6,16 +6,116 @@ If something goes wrong, returns string describing the error.
 """
 
 from ibc_config import IBCConfig as cf
+from modules.hdf5_creator import url_index
+from modules.work_ranges import remove_done
 from tables import openFile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import Image
 import hashlib
+from cStringIO import StringIO
 import cPickle
+import uuid
 import os
 
 
-def _get_img_list():
-    """Get a list of valid images, with old and new paths.
+def _load_manifest():
+    """Load a record of already normalized images.
+
+    Manifest has "sites": website folder names in "_img_dir" by raw folder,
+    "count": number of images named in each website folder, and "files":
+    (size, mtime, sha1, new path) by raw image path; sha1 and new path are
+    None for files which are not valid images. In HDF5 mode, "db_id" is
+    the database which has these images.
+    """
+    if (cf._manifest != "") and os.path.isfile(cf._manifest):
+        return cPickle.load(open(cf._manifest, "rb"))
+    return {"sites": {}, "count": {}, "files": {}, "db_id": None}
+
+
+def _save_manifest(manifest):
+    if cf._manifest == "":
+        return
+    temp = cf._manifest + ".tmp"
+    cPickle.dump(manifest, open(temp, "wb"), -1)
+    os.rename(temp, cf._manifest)  # never leave a broken manifest
+
+
+def _manifest_from_hdf5(Images, batch=100000):
+    """Rebuilds a manifest from images in HDF5 database.
+
+    Sizes and times of raw files are unknown, so files are checked
+    by their SHA1 instead. Invalid images are not recorded.
+    """
+    manifest = {"sites": {}, "count": {}, "files": {},
+                "db_id": Images.attrs.db_id}
+    for start in xrange(0, Images.nrows, batch):
+        rows = Images.read(start, min(start + batch, Images.nrows))
+        for img_raw, img_new, sha1 in zip(rows["true_name"], rows["file_name"],
+                                          rows["orig_sha1"]):
+            manifest["files"][img_raw] = (None, None, sha1, img_new)
+            site = os.path.relpath(img_raw, cf._raw_dir).split(os.sep)[0]
+            newdir = os.path.dirname(img_new)
+            manifest["sites"][site] = newdir
+            nr = int(os.path.basename(img_new)[3:9])  # from "img%06d.jpg"
+            manifest["count"][newdir] = max(manifest["count"].get(newdir, 0), nr)
+    return manifest
+
+
+def _sync_manifest(manifest, Images):
+    """Makes sure that manifest describes images of this HDF5 database.
+
+    Each database has a random id, kept in its manifest. If they differ
+    (database or manifest was deleted), manifest is rebuilt from database.
+    Databases from older versions get an id, and keep their manifest.
+    """
+    if "db_id" not in Images.attrs._v_attrnames:
+        Images.attrs.db_id = uuid.uuid4().hex
+        if "db_id" not in manifest:
+            manifest["db_id"] = Images.attrs.db_id
+    if manifest["db_id"] != Images.attrs.db_id:
+        if cf._show_progress and (len(manifest["files"]) > 0):
+            print "Manifest does not match %s, rebuilding it" % cf._hdf5
+        manifest.clear()
+        manifest.update(_manifest_from_hdf5(Images))
+
+
+def _walk_site(ws):
+    """List files of a website, with their sizes and modification times.
+    """
+    files = []
+    for root,dirs,fnames in os.walk(os.path.join(cf._raw_dir, ws[0])):
+        for f in fnames:
+            img_raw = os.path.join(root, f)
+            st = os.stat(img_raw)
+            files.append((img_raw, st.st_size, st.st_mtime))
+    return files
+
+
+def _unchanged(entry, img_raw, size, mtime):
+    """Check if a file from manifest does not need normalization.
+    """
+    if entry is None:
+        return False
+    if entry[0] is None:  # manifest rebuilt from database
+        if entry[2] in (None, ""):
+            return False
+        return hashlib.sha1(open(img_raw, 'rb').read()).hexdigest() == entry[2]
+    if (entry[0] != size) or (entry[1] != mtime):
+        return False
+    if (entry[2] is None) or (cf._mode == "hdf5"):
+        return True  # known invalid image, or already in database
+    # demo mode needs a preprocessed image, or a raw one in "shm" hand-off
+    return (cf._img_handoff == "shm") or os.path.isfile(entry[3])
+
+
+def _get_img_list(manifest):
+    """Get a list of new or changed files, with old and new paths.
+
+    Also returns unchanged images as (new path, website, raw path), and
+    new paths of changed images which replace their old versions. Websites
+    are walked in parallel, because raw folders can be very large.
     """    
     # load websites description
     wsd = []
@@ -23,6 +123,8 @@ def _get_img_list():
         # use [:-1] to remove "newline" character
         wsd.append(line[:-1].split(";"))
     imglist = []
+    unchanged = []
+    replaced = []
 
     # checking that img_dir exists
     if not os.path.isdir(cf._img_dir):
@@ -34,114 +136,233 @@ def _get_img_list():
         break
     Nws = len(dirs)  # current amount of websites
 
-    for ws in wsd:
-        # creating another website folder
-        Nws += 1
-        newdir = os.path.join(cf._img_dir, "ws%06d"%Nws)
-        os.mkdir(newdir)
-
-        # iterating over existing files
-        Nimg = 0  # image number in that website
-        for root,dirs,files in os.walk(os.path.join(cf._raw_dir, ws[0])):
-            for f in files:
-                img_raw = os.path.join(root, f)
-                
-                # check image size
-                if os.stat(img_raw).st_size < cf._min_size:
-                    print "Image %s too small" % img_raw.split("/")[-2:]
-                    continue
-                
-                # check if an image can be opened (= is a valid image file)
-                try:
-                    _ = Image.open(img_raw).convert('RGB')  # drop the result
-                except:
-                    print "Not a valid image: %s" % img_raw
-                    continue
-                
+    pool = ThreadPool(max(cf._norm_wrk, 1))
+    site_files = pool.map(_walk_site, wsd)
+    pool.close()
+
+    for ws, files in zip(wsd, site_files):
+        if ws[0] in manifest["sites"]:
+            newdir = manifest["sites"][ws[0]]
+        else:
+            # creating another website folder
+            Nws += 1
+            newdir = os.path.join(cf._img_dir, "ws%06d"%Nws)
+            os.mkdir(newdir)
+            manifest["sites"][ws[0]] = newdir
+
+        # iterating over existing files, they are checked when normalized
+        Nimg = manifest["count"].get(newdir, 0)  # image number in that website
+        for img_raw, size, mtime in files:
+            entry = manifest["files"].get(img_raw)
+            if _unchanged(entry, img_raw, size, mtime):
+                if entry[2] is not None:
+                    unchanged.append((entry[3], ws, img_raw))
+                manifest["files"][img_raw] = (size, mtime, entry[2], entry[3])
+                continue
+            if (entry is not None) and (entry[3] is not None):
+                img_new = entry[3]  # changed image keeps its name
+                replaced.append(img_new)
+            else:
                 Nimg += 1
                 img_new = os.path.join(newdir, "img%06d.jpg"%Nimg)
-                imglist.append((img_raw, img_new, ws))
-    return imglist    
+            imglist.append((img_raw, img_new, ws))
+            # not a valid image until normalized, but keeps its old name
+            old_new = None if entry is None else entry[3]
+            manifest["files"][img_raw] = (size, mtime, None, old_new)
+        manifest["count"][newdir] = Nimg
+    return imglist, unchanged, replaced
 
 
-def _normalize_images():
-    """Normalize images, no statistics kept.
+def _new_size(size):
+    """Size of a normalized image, not larger than "_max_dim".
     """
-    imglist = []
-    for img_raw, img_new, ws in _get_img_list():
-        img_obj = Image.open(img_raw).convert('RGB')
-
-        # check image dimensions, resize if needed
-        maxs = cf._max_dim
-        (x, y) = img_obj.size
-        if (x > maxs) and (x >= y):
-            y = int(y * (float(maxs) / x))
-            x = maxs
-            img_obj = img_obj.resize((x, y), Image.ANTIALIAS)
-        elif y > maxs:
-            x = int(x * (float(maxs) / y))
-            y = maxs
-            img_obj = img_obj.resize((x, y), Image.ANTIALIAS)        
-
-        # saving processed image
+    maxs = cf._max_dim
+    (x, y) = size
+    if (x > maxs) and (x >= y):
+        y = int(y * (float(maxs) / x))
+        x = maxs
+    elif y > maxs:
+        x = int(x * (float(maxs) / y))
+        y = maxs
+    return (x, y)
+
+
+def _decode(raw, fast_resize):
+    """Decode an image from memory, and downscale it if needed.
+
+    With fast_resize, JPEG decoder works at reduced scale (1/2, 1/4, 1/8)
+    which is still not smaller than the final size, then the image
+    is resized as usual. Returns an image and its original size.
+    """
+    img_obj = Image.open(StringIO(raw))
+    true_size = img_obj.size
+    new_size = _new_size(true_size)
+    if fast_resize and (img_obj.format == "JPEG") and (new_size != true_size):
+        img_obj.draft('RGB', new_size)
+    img_obj = img_obj.convert('RGB')
+    if img_obj.size != new_size:
+        img_obj = img_obj.resize(new_size, Image.ANTIALIAS)
+    return img_obj, true_size
+
+
+def _normalize_one(item):
+    """Normalize one image, return its information or None if not valid.
+
+    Runs in a worker process, so it only reads and writes image files.
+    A file is read once; size check, hashing, decoding and validation
+    work on that copy in memory. In "shm" hand-off only the image header
+    is read here, and descriptor extraction decodes the image, once.
+    """
+    img_raw, img_new, ws = item
+    raw = open(img_raw, 'rb').read()
+
+    # check image size
+    if len(raw) < cf._min_size:
+        print "Image %s too small" % img_raw.split("/")[-2:]
+        return None
+
+    # check if an image can be opened (= is a valid image file),
+    # resize it if needed
+    try:
+        if cf._img_handoff == "shm":
+            true_size = Image.open(StringIO(raw)).size
+            new_size = _new_size(true_size)
+        else:
+            img_obj, true_size = _decode(raw, cf._fast_resize)
+            new_size = img_obj.size
+    except:
+        print "Not a valid image: %s" % img_raw
+        return None
+
+    data = {} # all image information
+    data["true_size"] = true_size
+    data["true_name"] = img_raw
+    data["orig_sha1"] = hashlib.sha1(raw).hexdigest()
+    data["classN"] = int(ws[2])
+    data["ws_index"] = ws[1]  # just an URL here, find website index later
+    data["new_size"] = new_size
+
+    # saving processed image; in "shm" mode, descriptor extraction does it
+    data["file_name"] = img_new
+    if cf._img_handoff != "shm":
         img_obj.save(img_new, 'JPEG', quality=cf._jpeg_quality)
-        imglist.append((img_new, ws[1]))
+    return data
+
+
+def _normalize_all(imglist, manifest):
+    """Normalize all images, in parallel if "_norm_wrk" > 1.
+
+    Yields image information in the order of "_get_img_list", so that
+    a single writer stores results in a deterministic order.
+    Valid images are recorded in manifest.
+    """
+    if cf._norm_wrk > 1:
+        pool = Pool(cf._norm_wrk)
+        results = pool.imap(_normalize_one, imglist, chunksize=16)
+    else:
+        results = (_normalize_one(item) for item in imglist)
+    for data in results:
+        if data is not None:
+            size, mtime, _, _ = manifest["files"][data["true_name"]]
+            manifest["files"][data["true_name"]] = (size, mtime,
+                                                    data["orig_sha1"],
+                                                    data["file_name"])
+            yield data
+    if cf._norm_wrk > 1:
+        pool.close()
+        pool.join()
+
+
+def _normalize_images(manifest):
+    """Normalize images, no statistics kept.
+
+    Unchanged images from previous runs are listed without normalization.
+    """
+    newlist, unchanged, _ = _get_img_list(manifest)
+    imglist = [(img_new, ws[1], img_raw) for img_new, ws, img_raw in unchanged]
+    for data in _normalize_all(newlist, manifest):
+        imglist.append((data["file_name"], data["ws_index"],
+                        data["true_name"]))
     # saving image-website mapping
     cPickle.dump(imglist, open(cf._img_data, "wb"), -1)
         
         
-def _normalize_images_hdf5():
+def _find_rows(Images, names, batch=100000):
+    """Indices of images with given preprocessed file names, by name.
+    """
+    found = {}
+    if len(names) == 0:
+        return found
+    names = np.array(names)
+    for start in xrange(0, Images.nrows, batch):
+        col = Images.read(start, min(start + batch, Images.nrows),
+                          field="file_name")
+        for i in np.where(np.in1d(col, names))[0]:
+            found[col[i]] = start + i
+    return found
+
+
+def _replace_images(Images, imglist, old):
+    """Writes changed images over their old records.
+
+    Descriptors and representation of these images are computed again.
+    Old records of images which are not valid any more get no regions.
+    Returns images which are not replacements.
+    """
+    new = []
+    redo = []
+    for data in imglist:
+        idx = old.pop(data["file_name"], None)
+        if idx is None:
+            new.append(data)
+            continue
+        row = Images.read(idx, idx+1)
+        for name in ("orig_sha1", "true_size", "new_size", "true_name"):
+            row[name] = data[name]
+        row["reg_first"] = -1
+        row["reg_count"] = -1
+        Images.modify_rows(idx, idx+1, rows=row)
+        redo.append(idx)
+    remove_done(Images, "descr_done", redo)
+    for idx in old.values():
+        Images.modify_columns(idx, idx+1, columns=[[-1], [0]],
+                              names=["reg_first", "reg_count"])
+    remove_done(Images, "repr_done", redo + old.values())
+    return new
+
+
+def _normalize_images_hdf5(manifest):
     """Normalize images, write image records with statistics to HDF5 file.
-    """    
-    imglist = []  # new list with all image attributes, to fill HDF5
-    for img_raw, img_new, ws in _get_img_list():
-        img_obj = Image.open(img_raw).convert('RGB')
-        data = {} # all image information
-
-        data["true_size"] = img_obj.size
-        data["true_name"] = img_raw
-        data["orig_sha1"] = hashlib.sha1(open(img_raw, 'r').read()).hexdigest()
-        data["classN"] = int(ws[2])
-        data["ws_index"] = ws[1]  # just an URL here, find website index later
-        
-        # check image dimensions, resize if needed
-        maxs = cf._max_dim
-        (x, y) = img_obj.size
-        if (x > maxs) and (x >= y):
-            y = int(y * (float(maxs) / x))
-            x = maxs
-            img_obj = img_obj.resize((x, y), Image.ANTIALIAS)
-        elif y > maxs:
-            x = int(x * (float(maxs) / y))
-            y = maxs
-            img_obj = img_obj.resize((x, y), Image.ANTIALIAS)        
-        data["new_size"] = img_obj.size
-
-        # saving processed image
-        data["file_name"] = img_new
-        img_obj.save(img_new, 'JPEG', quality=cf._jpeg_quality)
-        
-        # adding image information
-        imglist.append(data)
 
-    # finding website indices
+    Only new or changed images are added, unchanged ones are already there.
+    Changed images replace their old records.
+    """    
     db = openFile(cf._hdf5, "a")
     Websites = db.root.Websites
+    Images = db.root.Images
+    _sync_manifest(manifest, Images)
+    newlist, _, replaced = _get_img_list(manifest)
+    # all image attributes, to fill HDF5
+    imglist = list(_normalize_all(newlist, manifest))
+    imglist = _replace_images(Images, imglist, _find_rows(Images, replaced))
+
+    # finding website indices
+    ws_index = url_index(Websites)
     nr_in_site = {}
     for data in imglist:
-        url = data["ws_index"]
-        idx = Websites.readWhere('url=="%s"'%url, field="index")[0]
+        idx = ws_index[data["ws_index"]]
         data["ws_index"] = idx
         # calculating Images.nr_in_site, and Websites.img_present
-        if not idx in nr_in_site:  # add another website      :
-            nr_in_site[idx] = 0
-            data["nr_in_site"] = 0
+        if not idx in nr_in_site:  # add another website
+            # continue after images from previous runs, if any
+            nr_in_site[idx] = Websites.read(idx, idx+1,
+                                            field="img_present")[0] + 1
+            data["nr_in_site"] = nr_in_site[idx]
         else:
             nr_in_site[idx] += 1
             data["nr_in_site"] = nr_in_site[idx]
     
     # writing image table records
-    Images = db.root.Images
     img_last = Images.attrs.last_index
     nr_in_class = Images.attrs.nr_in_class
 
@@ -178,10 +399,12 @@ def _normalize_images_hdf5():
 def normalize_images():
     """Chooses either single or batch version.
     """
+    manifest = _load_manifest()
     if cf._mode == "hdf5":
-        _normalize_images_hdf5()
+        _normalize_images_hdf5(manifest)
     else:
-        _normalize_images()
+        _normalize_images(manifest)
+    _save_manifest(manifest)
 
 
 
@@ -6,8 +6,12 @@ Created on Wed Jun 26 12:58:26 2013
 """
 
 from ibc_config import IBCConfig as cf
+from nn.centroids import load_centroids
+from modules.hdf5_creator import url_index
+from modules.work_ranges import runs
+from modules.demo_store import DemoStore
+from modules.grouping import factorize, group_sum, group_count
 from tables import openFile
-import cPickle
 import numpy as np
 import os
 
@@ -17,27 +21,49 @@ class Repr(object):
     """
     
     def __init__(self):
-        C = cPickle.load(open(cf._C_file, "rb"))
+        C = load_centroids()  # memory-mapped if possible
         self.C = C["C"]
         self.L_mj = C["L_majority"]  # majority vote labels
         self.L_soft = C["L_soft"]  # soft labels
 
+    def _labels(self, c):
+        """Majority and soft labels of neighbours c, as rows.
+        """
+        c = np.asarray(c, dtype=np.int64)
+        return np.hstack((self.L_mj[c], self.L_soft[c])).astype(np.float64)
+
     def _repr(self, c, d):
         """Get the whole representation as a vector.
         
         c = indexes of neighbours
         d = distances to neighbours
         """
-        l1 = self.L_mj.shape[1]
-        l2 = self.L_soft.shape[1]
-        result = np.zeros((l1 + l2, ), dtype=np.float64)
-        for c1 in c:
-            result[:l1] += self.L_mj[c1]
-            result[l1:] += self.L_soft[c1]
+        c = np.asarray(c, dtype=np.int64)
+        result = np.hstack((self.L_mj[c].sum(0), self.L_soft[c].sum(0)))
+        result = np.asarray(result, dtype=np.float64)
         # divide by the amount of samples
         if c.shape[0] > 0:
             result = result / c.shape[0]
         return result
+
+    def _repr_bulk(self, c, first, count):
+        """Get representations of many images at once.
+
+        c = first neighbours of consecutive regions
+        first, count = position and number of regions of each image in c,
+                       images without regions get zero representation
+        """
+        L = self._labels(c)
+        L = np.vstack((L, np.zeros((1, L.shape[1]))))  # allows ends = len(c)
+        result = np.zeros((len(first), L.shape[1]), dtype=np.float64)
+        full = np.where(count > 0)[0]
+        if len(full) == 0:
+            return result
+        # sums over [first, end) of each image are at even positions
+        bounds = np.vstack((first[full], first[full] + count[full])).T.ravel()
+        sums = np.add.reduceat(L, bounds, axis=0)[::2]
+        result[full] = sums / count[full][:, None]
+        return result
         
 
 ##############################################################################
@@ -52,29 +78,85 @@ def get_repr(all_repr=False):
 
 
 def _get_repr():
-    """Get image representation from "_img_data" file.
+    """Get image representation from demo store.
+
+    Labels of first neighbours are summed by image number ("img" column)
+    for "_repr_batch" regions at a time. Representations are saved as
+    "img_repr" column with image numbers in "repr_img".
     """
     obj = Repr()
-    data = cPickle.load(open(cf._img_data, "rb"))
-
+    store = DemoStore()
+    n_img = len(store.load_images())
+    sums = np.zeros((n_img, obj.L_mj.shape[1] + obj.L_soft.shape[1]))
+    counts = np.zeros((n_img,), dtype=np.int64)
+    n = store.nrows("img")
+    for lo in xrange(0, n, cf._repr_batch):
+        hi = min(lo + cf._repr_batch, n)
+        img, groups = factorize(store.read("img", lo, hi))
+        c = store.read("neighbours", lo, hi)[:, 0, 0]
+        sums[img] += group_sum(groups, obj._labels(c), len(img))
+        counts[img] += group_count(groups, len(img))
+
+    ids = np.where(counts > 0)[0]
+    store.drop("repr_img", "img_repr")
+    store.append("repr_img", ids)
+    store.append("img_repr", sums[ids] / counts[ids][:, None])
+
+
+def _write_repr(Images, index, R):
+    """Writes representations of images, one call per run of indices.
+    """
+    order = np.argsort(index, kind="mergesort")
+    index = index[order]
+    R = R[order]
+    i = 0
+    for start, stop in runs(index):
+        Images.modify_column(start, stop, colname="img_repr",
+                             column=R[i:i+stop-start])
+        i += stop - start
 
-    img = list(set([d[0] for d in data]))  # get a list of unique image names
-    repr1 = [[[],[]]] * len(img)  # repr[image_index][c,d][region]
-    ws = [[]] * len(img)  # list of websites
-    for d in data:
-        imgidx = img.index(d[0])
-        ws[imgidx] = d[1][-1]
-        c, d = d[3]
-        repr1[imgidx][0].append(c[0])
-        repr1[imgidx][1].append(d)
 
-    repr2 = []
-    for i in xrange(len(repr1)):
-        c = np.asarray(repr1[i][0])
-        d = np.asarray(repr1[i][1])
-        repr2.append([ws[i], obj._repr(c, d)])
+def _bulk_repr(obj, Regions, Images, index, first, count):
+    """Fills representations of the given images.
 
-    cPickle.dump(repr2, open(cf._img_data, "wb"), -1)
+    Images are sorted by their first region, and "neighbours" of Regions
+    are read in chunks of about "_repr_batch" rows.
+    """
+    count = np.maximum(count, 0)  # -1 for images without descriptors yet
+    empty = (count == 0)
+    if np.any(empty):
+        R = np.zeros((np.sum(empty), 2*cf._maxc), dtype=np.float64)
+        _write_repr(Images, index[empty], R)
+
+    order = np.argsort(first[~empty], kind="mergesort")
+    index = index[~empty][order]
+    first = first[~empty][order]
+    count = count[~empty][order]
+    read_c = lambda lo, hi: Regions.read(lo, hi, field="neighbours")[:, 0, 0]
+    for i, j, R in _repr_blocks(obj, read_c, first, count):
+        _write_repr(Images, index[i:j], R)
+
+
+def _repr_blocks(obj, read_c, first, count):
+    """Yields representations R of images i:j as (i, j, R).
+
+    Images must be sorted by their first region and have regions. First
+    neighbours of about "_repr_batch" regions at once are obtained by
+    "read_c(start, stop)".
+    """
+    end = first + count
+    i = 0
+    while i < len(first):
+        # at least one image per chunk, even a large one
+        j = np.searchsorted(end, first[i] + cf._repr_batch, side="right")
+        j = max(j, i + 1)
+        lo = first[i]
+        hi = end[j-1]
+        R = obj._repr_bulk(read_c(lo, hi), first[i:j] - lo, count[i:j])
+        yield i, j, R
+        i = j
+        if cf._show_progress:
+            print "img_repr: %d/%d" % (i, len(first))
 
 
 def _get_repr_hdf5(all_repr):
@@ -86,25 +168,25 @@ def _get_repr_hdf5(all_repr):
     Images = db.root.Images
     Regions = db.root.Regions
 
-    images = []    
     if all_repr:  # recalculate everything
-        for row in Images.iterrows():
-            images.append([row["index"], row["reg_first"], row["reg_count"]]) 
+        index = Images.col("index")
+        first = Images.col("reg_first")
+        count = Images.col("reg_count")
     else:  # recalculate just new ones
-        for img in open(cf._ws_descr).readlines():
+        ws_index = url_index(Websites)
+        wsidx = []
+        for line in open(cf._ws_descr).readlines():
             url = line.split(";")[1]
-            wsidx = Websites.readWhere('url == "%s"'%url, field="index")[-1]
-            imgrows = Images.readWhere('site_index == %d'%wsidx)
-            for row in imgrows:
-                images.append([row["index"], row["reg_first"], row["reg_count"]]) 
-
-    for img in images:
-        data = Regions.read(img[1], img[1]+img[2], field="neighbours")
-        c = data[:, 0, 0]  # first of the neighbours
-        d = data[:, 1, :]  # all distances
-        r = obj._repr(c, d)  # obtain representation
-        Images.modify_column(img[0], colname="img_repr", column=r)
-        
+            if url in ws_index:
+                wsidx.append(ws_index[url])
+        # images of these websites, found in one pass over Images
+        sites = Images.col("site_index")
+        rows = Images.read_coordinates(np.where(np.in1d(sites, wsidx))[0])
+        index = rows["index"]
+        first = rows["reg_first"]
+        count = rows["reg_count"]
+
+    _bulk_repr(obj, Regions, Images, index, first, count)
     Images.flush()
     db.close()
 
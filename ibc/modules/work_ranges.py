@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Finished rows of HDF5 tables, stored as ranges in small arrays.
+
+An array "/done/<table>_<name>" (like "/done/Regions_nn_done") keeps
+a sorted (n, 2) array of [start, stop) ranges of rows that are already
+processed. Pending rows are listed from it in time proportional to their
+number, without scanning the table. Ranges are only added after the data
+is flushed, so a row may be done twice after a crash, but never skipped.
+
+Arrays are used instead of table attributes, which HDF5 limits to 64KB.
+Attributes written by older versions are still read, and moved to arrays.
+"""
+
+from tables import Int64Atom
+import numpy as np
+
+
+def runs(idx):
+    """Splits indices into (n, 2) array of [start, stop) consecutive runs.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    if len(idx) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    breaks = np.where(np.diff(idx) != 1)[0] + 1
+    starts = idx[np.hstack(([0], breaks))]
+    stops = idx[np.hstack((breaks - 1, [len(idx) - 1]))] + 1
+    return np.vstack((starts, stops)).T
+
+
+def merge(ranges):
+    """Sorts ranges and joins overlapping or touching ones.
+    """
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    if len(ranges) == 0:
+        return ranges
+    r = ranges[np.argsort(ranges[:, 0], kind="mergesort")]
+    ends = np.maximum.accumulate(r[:, 1])
+    first = np.hstack(([0], np.where(r[1:, 0] > ends[:-1])[0] + 1))
+    stops = np.maximum.reduceat(r[:, 1], first)
+    return np.vstack((r[first, 0], stops)).T
+
+
+def _node(table, name):
+    return "%s_%s" % (table.name, name)
+
+
+def get_done(table, name):
+    """Finished ranges of a table, or None for files without them.
+    """
+    db = table._v_file
+    if ("done" in db.root) and (_node(table, name) in db.root.done):
+        return db.getNode(db.root.done, _node(table, name)).read()
+    if name in table.attrs._v_attrnames:  # from older versions
+        return np.asarray(getattr(table.attrs, name),
+                          dtype=np.int64).reshape(-1, 2)
+    return None
+
+
+def set_done(table, name, ranges):
+    """Replaces finished ranges of a table.
+    """
+    db = table._v_file
+    if "done" not in db.root:
+        db.createGroup(db.root, "done")
+    if _node(table, name) in db.root.done:
+        db.removeNode(db.root.done, _node(table, name))
+    arr = db.createEArray(db.root.done, _node(table, name), Int64Atom(),
+                          (0, 2), expectedrows=max(len(ranges), 1000))
+    arr.append(np.asarray(ranges, dtype=np.int64).reshape(-1, 2))
+    arr.close()  # flushes data
+    if name in table.attrs._v_attrnames:
+        delattr(table.attrs, name)  # moved from attribute
+
+
+def add_done(table, name, ranges):
+    """Marks ranges of a table as finished.
+
+    Nothing is stored in files without finished ranges yet, they are
+    found by "pending" from the data itself.
+    """
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    done = get_done(table, name)
+    if (len(ranges) == 0) or (done is None):
+        return
+    set_done(table, name, merge(np.vstack((done, ranges))))
+
+
+def remove_done(table, name, idx):
+    """Marks rows of a table as not finished, to process them again.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    done = get_done(table, name)
+    if (len(idx) == 0) or (done is None) or (len(done) == 0):
+        return
+    finished = np.zeros((done[-1, 1],), dtype=np.bool)
+    for start, stop in done:
+        finished[start:stop] = True
+    finished[idx[idx < len(finished)]] = False
+    set_done(table, name, runs(np.where(finished)[0]))
+
+
+def pending(table, name, scan, batch=1000000):
+    """Indices of table rows which are not finished yet.
+
+    Files from older versions have no finished ranges; then "scan(start,
+    stop)" returns a boolean array of finished rows, the table is checked
+    in chunks once, and the ranges are saved for the next time.
+    """
+    n = table.nrows
+    done = get_done(table, name)
+    if done is None:
+        idx = [np.zeros((0,), dtype=np.int64)]
+        for start in xrange(0, n, batch):
+            stop = min(start + batch, n)
+            idx.append(np.where(scan(start, stop))[0] + start)
+        done = runs(np.concatenate(idx))
+        set_done(table, name, done)
+
+    return gaps(done, n)
+
+
+def gaps(done, n):
+    """Indices from 0 to n-1 which are not in sorted merged ranges "done".
+    """
+    done = np.asarray(done, dtype=np.int64).reshape(-1, 2)
+    # gaps between finished ranges, and after the last one
+    bounds = np.hstack(([0], done.ravel(), [n])).reshape(-1, 2)
+    bounds = bounds[bounds[:, 1] > bounds[:, 0]]
+    if len(bounds) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    return np.hstack([np.arange(a, b) for a, b in bounds])
@@ -82,6 +82,12 @@ class MPMaster(Process):
         """
         raise NotImplementedError
 
+
+    def finalize(self):
+        """Called once after all results are processed.
+        """
+        pass
+
         
     def report(self, last_t):
         """Prints time left.
@@ -176,6 +182,8 @@ class MPMaster(Process):
             if cf._show_progress:
                 self.report(last_t)
             time.sleep(max(3 - time.time() + t0, 0.1))  # sleep 0.1-3 seconds
+
+        self.finalize()
                                         
         # profiling
         if self.profiling:
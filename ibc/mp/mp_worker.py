@@ -6,7 +6,7 @@ Created on Sat Apr  6 21:01:26 2013
 """
 
 from ibc_config import IBCConfig as cf
-from sift.csift_extractor import csift
+from sift.csift_extractor import csift, csift_batch, csift_raw
 from nn.pdist import PDist
 from multiprocessing.managers import BaseManager
 from multiprocessing import Process
@@ -49,9 +49,18 @@ class MPWorker(Process):
             
             if task[0] == "csift":
                 result = (csift(task[1], self.idx), task[2])
+            elif task[0] == "csift_batch":
+                # task[1] and task[2] are lists of images and their indices
+                result = (csift_batch(task[1], self.idx), task[2])
+            elif task[0] == "csift_raw":
+                # same as "csift_batch", but from (raw, preprocessed) images
+                result = (csift_raw(task[1], self.idx), task[2])
             elif task[0] == "nn":
                 # task[2] are start and stop indices of descriptors
                 result = (pd.get_knn(task[1]), task[2])
+            elif task[0] == "nn_repr":
+                # task[3] are numbers of descriptors of images from task[2]
+                result = (pd.get_repr(task[1], task[3]), task[2])
             else:
                 result = "Unknown task type"
                 
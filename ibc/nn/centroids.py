@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Binary centroid store, shared by all worker processes.
+
+Centroids file "_C_file" is a pickle, so each process which loads it keeps
+a private copy. Converted store in "_C_dir" has a separate .npy file for
+every array, and they are memory-mapped read-only: all processes on a node
+share one copy in page cache, and startup does not need unpickling.
+
+Store contains original "C", "L_majority", "L_soft" arrays, and centroids
+prepared for PDist engines together with their squared norms. It also
+keeps a signature of "_C_file", and is rebuilt when the file changes.
+
+Usage: "python centroids.py" converts "_C_file" to "_C_dir".
+"""
+
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ibc_config import IBCConfig as cf
+import cPickle
+import numpy as np
+
+
+_VERSION = 2  # format of the store, 2 has float32 "Cq"
+
+
+def _path(name):
+    return os.path.join(cf._C_dir, name + ".npy")
+
+
+def signature():
+    """Identifies "_C_file" by its size and time, None if there is no file.
+    """
+    if not os.path.isfile(cf._C_file):
+        return None
+    st = os.stat(cf._C_file)
+    return "%d;%d;%d" % (st.st_size, st.st_mtime, _VERSION)
+
+
+def has_store():
+    """Checks if converted centroids are available and up to date.
+
+    Store is used without checks if there is no "_C_file".
+    """
+    if (cf._C_dir == "") or (not os.path.isfile(_path("C"))):
+        return False
+    sig = signature()
+    if sig is None:
+        return True
+    sig_file = os.path.join(cf._C_dir, "signature.txt")
+    return os.path.isfile(sig_file) and (open(sig_file).read() == sig)
+
+
+def load_ivf():
+    """Loads approximate search index from "_C_ivf", or returns None.
+
+    Index made for other centroids than in "_C_file" is ignored.
+    """
+    if not os.path.isfile(cf._C_ivf):
+        return None
+    ivf = cPickle.load(open(cf._C_ivf, "rb"))
+    sig = signature()
+    if (sig is not None) and (ivf.get("signature") != sig):
+        return None
+    return ivf
+
+
+def prepare(C, dtype):
+    """Centroids in given precision, and their squared norms.
+    """
+    C = np.ascontiguousarray(C, dtype=dtype)
+    return C, np.einsum('ij,ij->i', C, C)
+
+
+def quantize(C):
+    """Centroids rounded to integers, their norms and rounding errors.
+    """
+    Cq = np.clip(np.round(C), 0, 255)
+    Cq_err = np.sqrt(np.sum((C - Cq)**2, 1))
+    Cq = Cq.astype(np.float32)  # integers, exact in float32
+    return Cq, np.einsum('ij,ij->i', Cq, Cq, dtype=np.float64), Cq_err
+
+
+def load_centroids():
+    """Loads centroids and their labels, as a dictionary.
+
+    Arrays are memory-mapped from "_C_dir" if it exists, otherwise loaded
+    from "_C_file". Returns None if there are no centroids.
+    """
+    if has_store():
+        C = {}
+        for name in ("C", "L_majority", "L_soft"):
+            C[name] = np.load(_path(name), mmap_mode="r")
+        return C
+    if os.path.isfile(cf._C_file):
+        return cPickle.load(open(cf._C_file, "rb"))
+    return None
+
+
+def load_prepared(dtype):
+    """Prepared centroids and norms for "gemm" engine, memory-mapped.
+    """
+    name = "C_" + np.dtype(dtype).name
+    if has_store() and os.path.isfile(_path(name)):
+        return (np.load(_path(name), mmap_mode="r"),
+                np.load(_path("C2_" + np.dtype(dtype).name), mmap_mode="r"))
+    return prepare(load_centroids()["C"], dtype)
+
+
+def load_quantized():
+    """Prepared centroids, norms and errors for "uint8" engine, memory-mapped.
+    """
+    if has_store() and os.path.isfile(_path("Cq")):
+        Cq = np.load(_path("Cq"), mmap_mode="r")
+        if Cq.dtype == np.float32:  # older stores have int32
+            return tuple([Cq] + [np.load(_path(name), mmap_mode="r")
+                                 for name in ("Cq2", "Cq_err")])
+    return quantize(load_centroids()["C"])
+
+
+def convert_centroids():
+    """Converts "_C_file" pickle into a binary store in "_C_dir".
+    """
+    if not os.path.isfile(cf._C_file):
+        print "No centroids in %s" % cf._C_file
+        return
+    if cf._show_progress:
+        print "Converting centroids to %s" % cf._C_dir
+    if not os.path.isdir(cf._C_dir):
+        os.mkdir(cf._C_dir)
+    if os.path.isfile(_path("C")):
+        os.remove(_path("C"))  # old store is not complete any more
+    sig = signature()
+    data = cPickle.load(open(cf._C_file, "rb"))
+    arrays = {}
+    for name in ("C", "L_majority", "L_soft"):
+        arrays[name] = np.asarray(data[name])
+    for dtype in (np.float32, np.float64):
+        name = np.dtype(dtype).name
+        arrays["C_" + name], arrays["C2_" + name] = prepare(data["C"], dtype)
+    arrays["Cq"], arrays["Cq2"], arrays["Cq_err"] = quantize(data["C"])
+
+    # "C" is written last, because it marks a complete store
+    for name in sorted(arrays, key=lambda n: n == "C"):
+        if name == "C":
+            open(os.path.join(cf._C_dir, "signature.txt"), "w").write(sig)
+        np.save(_path(name), arrays[name])
+
+
+if __name__ == "__main__":
+    convert_centroids()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Inverted file index for approximate nearest centroid search.
+
+Centroids from "_C_file" are clustered with k-means into "_ivf_lists" lists,
+index is saved to "_C_ivf" and used by PDist if "_nn_index" = "ivf". Index
+keeps a signature of "_C_file", and is ignored if the file has changed.
+
+Usage: "python ivf.py build" creates an index,
+       "python ivf.py report" compares it to the exact search.
+"""
+
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ibc_config import IBCConfig as cf
+from pdist import PDist, _sqdist, _ksmallest
+from centroids import load_centroids, signature
+from modules.hdf5_creator import DescriptorStore
+from modules.demo_store import DemoStore
+from tables import openFile
+import cPickle
+import numpy as np
+import time
+
+
+def _kmeans(X, n, n_iter):
+    """Basic k-means, returns cluster centers and assignments of X.
+    """
+    X2 = np.einsum('ij,ij->i', X, X)
+    Q = X[np.random.permutation(X.shape[0])[:n]].copy()
+    for _ in xrange(n_iter):
+        Q2 = np.einsum('ij,ij->i', Q, Q)
+        assign = np.argmin(_sqdist(X, X2, Q, Q2), 1)
+        counts = np.bincount(assign, minlength=n)
+        Q = np.zeros(Q.shape)
+        np.add.at(Q, assign, X)
+        empty = np.where(counts == 0)[0]
+        # re-seed empty clusters with random centroids
+        Q[empty] = X[np.random.permutation(X.shape[0])[:len(empty)]]
+        counts[empty] = 1
+        Q /= counts[:, None]
+    Q2 = np.einsum('ij,ij->i', Q, Q)
+    assign = np.argmin(_sqdist(X, X2, Q, Q2), 1)
+    return Q, assign
+
+
+def build_ivf(n_iter=10):
+    """Builds an index for centroids from "_C_file", saves it to "_C_ivf".
+    """
+    C = np.asarray(load_centroids()["C"], dtype=np.float64)
+    n = cf._ivf_lists
+    if n <= 0:  # default number of lists
+        n = int(np.sqrt(C.shape[0]))
+    if cf._show_progress:
+        print "Building IVF index with %d lists..." % n
+    Q, assign = _kmeans(C, n, n_iter)
+
+    ivf = {}
+    ivf["Q"] = Q
+    ivf["Q2"] = np.einsum('ij,ij->i', Q, Q)
+    ivf["order"] = np.argsort(assign, kind="mergesort")
+    ivf["offsets"] = np.hstack(([0], np.cumsum(np.bincount(assign, minlength=n))))
+    ivf["signature"] = signature()  # index is rebuilt when centroids change
+    cPickle.dump(ivf, open(cf._C_ivf, "wb"), -1)
+
+
+def _get_descr(n):
+    """Gets first n descriptors from the database, for testing.
+    """
+    if cf._mode == "hdf5":
+        db = openFile(cf._hdf5, "r")
+        D = DescriptorStore(db).read_range(0, n)
+        db.close()
+    else:
+        store = DemoStore()
+        D = np.array(store.read("descriptors", 0, min(n, store.nrows("descriptors"))))
+    return D
+
+
+def recall_report(D, probes=(1, 2, 4, 8, 16, 32)):
+    """Shows how often approximate neighbours match the exact ones.
+
+    Recall is a share of exact k nearest neighbours found by the index,
+    "1nn" is a share of descriptors with a correct first neighbour.
+    """
+    pd = PDist()
+    if pd.ivf is None:
+        print "No IVF index, set _nn_index = 'ivf' and build it first"
+        return
+    k = cf._nn_count
+    t = time.time()
+    e_idx, _ = pd._gemm_knn(D, k)
+    t_exact = time.time() - t
+    print "exact: %.0f descr/s" % (D.shape[0] / t_exact)
+
+    for p in probes:
+        cf._ivf_probe = p
+        t = time.time()
+        a_idx, _ = pd._ivf_knn(D, k)
+        t_ivf = time.time() - t
+        found = np.mean([len(np.intersect1d(e_idx[i], a_idx[i]))
+                         for i in xrange(D.shape[0])]) / k
+        first = np.mean(e_idx[:, 0] == a_idx[:, 0])
+        print ("probe %d: recall@%d = %.03f, 1nn = %.03f, "
+               "%.0f descr/s (%.1fx faster)" %
+               (p, k, found, first, D.shape[0] / t_ivf, t_exact / t_ivf))
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "build":
+        build_ivf()
+    elif sys.argv[1] == "report":
+        recall_report(_get_descr(10000))
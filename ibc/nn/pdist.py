@@ -1,45 +1,223 @@
 """Computes pairwise distances.
 
-Currently, 'cdist()' function from scipy is the fastest, although it uses only
-one core. Using np.sum(np.power(dist,2),2) is 10x slower.
+Scipy 'cdist()' function uses only one core. Using np.sum(np.power(dist,2),2)
+is 10x slower. The "gemm" engine expands squared euclidean distance as
+||d||^2 + ||c||^2 - 2*D*C', so the heavy part is one matrix product done by
+multithreaded BLAS. Centroids are processed in blocks of "_nn_block",
+so a full distance matrix is never kept in memory.
+
+The "uint8" engine gives exact distances from stored uint8 descriptors to
+centroids rounded to integers once at load time. Numpy has no fast integer
+matrix product, so it runs on float32 BLAS: a float32 sum of up to 258
+products of values in [0, 255] is below 2^24 and thus exact, so dimensions
+are split in such parts and their dot products are added in float64.
+
+Optional approximate search uses an inverted file index ("_nn_index" = "ivf"),
+built by "nn/ivf.py". Centroids are split into clusters, and each descriptor
+is compared only to centroids from "_ivf_probe" closest clusters.
 """
 from ibc_config import IBCConfig as cf
-import cPickle
+from centroids import load_centroids, load_prepared, load_quantized,\
+                      load_ivf, prepare, quantize
+from modules.grouping import group_sum
 import numpy as np
-import os
 import scipy.spatial.distance as distance
 from bottleneck import argpartsort  # finding k smallest elements fast
 
 
+def _sqdist(D, D2, C, C2):
+    """Squared euclidean distances from D to C, given their squared norms.
+    """
+    dist = np.dot(D, C.T)
+    dist *= -2
+    dist += D2[:, None]
+    dist += C2[None, :]
+    np.maximum(dist, 0, dist)  # rounding errors give small negatives
+    return dist
+
+
+_EXACT_DIM = 2**24 // 255**2  # float32 sums of so many uint8 products are exact
+
+
+def _sqdist_exact(D, D2, C, C2):
+    """Exact squared distances between integer-valued float32 D and C.
+
+    Dot products are computed by float32 BLAS over parts of dimensions
+    small enough for exact sums, and added in float64.
+    """
+    dist = np.dot(D[:, :_EXACT_DIM], C[:, :_EXACT_DIM].T).astype(np.float64)
+    for i in xrange(_EXACT_DIM, D.shape[1], _EXACT_DIM):
+        dist += np.dot(D[:, i:i+_EXACT_DIM], C[:, i:i+_EXACT_DIM].T)
+    dist *= -2
+    dist += D2[:, None]
+    dist += C2[None, :]
+    return dist
+
+
+def _ksmallest(dist, k):
+    """Get k smallest elements of each row, sorted in ascending order.
+
+    Returns indices of these elements and their values.
+    """
+    L = dist.shape[0]  # number of samples
+    rows = np.arange(L)[:, None]
+    if k < dist.shape[1]:
+        k_idx = argpartsort(dist, k, 1)[:, :k]  # getting K smallest indices, unordered
+    else:
+        k_idx = np.tile(np.arange(dist.shape[1]), (L, 1))
+    k_dist = dist[rows, k_idx]  # get distances, unordered
+    idx = np.argsort(k_dist, 1)  # get correct ordering
+    return k_idx[rows, idx], k_dist[rows, idx]
+
+
 class PDist(object):
     """Implementation of pairwise distance calculation.
 
     Distance function is set to squared euclidean. No results for
     other functions yet, but they can do as well.
 
-    Eats something like 30% of the total image classification time.
-    Fast parallel BLAS or GPU implementation would be beneficial.
+    Engine is chosen by "_nn_engine" parameter: "cdist" is the original
+    single-core version, "gemm" runs on BLAS in "_nn_dtype" precision,
+    "uint8" gives exact distances to rounded centroids with float32 BLAS.
+    All return the same values: int indices and float64 distances.
     """
 
-    def __init__(self):
+    def __init__(self, C=None):
         """Initialize object with constant centroids.
-        """        
-        if os.path.isfile(cf._C_file):
-            self.C = cPickle.load(open(cf._C_file, "rb"))["C"]
-        else:  
-            # centroids have not been initialized yet
-            self.C = None
+
+        Centroids are memory-mapped from "_C_dir" binary store, or loaded
+        from "_C_file" if there is no store, unless given explicitly.
+        Index and labels are used only with centroids from file.
+        """
+        self.ivf = None
+        self.L_mj = None  # labels, for "get_repr"
+        self.L_soft = None
+        self.engine = cf._nn_engine
+        self.dtype = np.dtype(cf._nn_dtype)
+        if C is None:
+            C = load_centroids()
+            if C is None:
+                # centroids have not been initialized yet
+                self.C = None
+                return
+            self.L_mj = C["L_majority"]
+            self.L_soft = C["L_soft"]
+            C = C["C"]
+            if cf._nn_index == "ivf":
+                self.ivf = load_ivf()
+            from_store = True
+        else:
+            from_store = False
+
+        self.C = C
+        if (self.engine == "gemm") or (self.ivf is not None):
+            if from_store:
+                self.C, self.C2 = load_prepared(self.dtype)
+            else:
+                self.C, self.C2 = prepare(C, self.dtype)
+        if self.engine == "uint8":
+            if from_store:
+                self.Cq, self.Cq2, self.Cq_err = load_quantized()
+            else:
+                self.Cq, self.Cq2, self.Cq_err = quantize(C)
+
+
+    def rank_error_bound(self):
+        """Bound on ranking errors of the "uint8" engine.
+
+        Rounding moves centroid c by e_c = ||c - round(c)||, so the true
+        distance differs from the computed one by at most e_c (in not
+        squared distance). Centroids a and b can change their order only if
+        their true distances differ by less than e_a + e_b, which is never
+        more than the returned value (and at most sqrt(384) = 19.6).
+        """
+        if self.engine != "uint8":
+            return 0.0
+        return 2 * np.max(self.Cq_err)
+
+
+    def _gemm_knn(self, D, k):
+        """Blocked search of k nearest centroids, keeps k best per block.
+        """
+        if self.engine == "uint8":
+            D = np.ascontiguousarray(D, dtype=np.float32)
+            C, C2 = self.Cq, self.Cq2
+            sqdist = _sqdist_exact
+            D2 = np.einsum('ij,ij->i', D, D, dtype=np.float64)
+        else:
+            D = np.ascontiguousarray(D, dtype=self.dtype)
+            C, C2 = self.C, self.C2
+            sqdist = _sqdist
+            D2 = np.einsum('ij,ij->i', D, D)
+        N = C.shape[0]
+        best_idx = np.empty((D.shape[0], 0), dtype=np.intp)
+        best_dist = np.empty((D.shape[0], 0), dtype=C2.dtype)
+        for j0 in xrange(0, N, cf._nn_block):
+            j1 = min(j0 + cf._nn_block, N)
+            dist = sqdist(D, D2, C[j0:j1], C2[j0:j1])
+            b_idx, b_dist = _ksmallest(dist, k)
+            # merge block candidates with the best ones so far
+            cand_idx = np.hstack((best_idx, b_idx + j0))
+            cand_dist = np.hstack((best_dist, b_dist))
+            sel, best_dist = _ksmallest(cand_dist, k)
+            best_idx = cand_idx[np.arange(D.shape[0])[:, None], sel]
+        return best_idx, best_dist.astype(np.float64)
+
+
+    def _ivf_knn(self, D, k):
+        """Approximate search of k nearest centroids with inverted file.
+
+        Descriptors which got less than k candidates from the probed
+        clusters are processed by exact search.
+        """
+        D = np.ascontiguousarray(D, dtype=self.dtype)
+        D2 = np.einsum('ij,ij->i', D, D)
+        L = D.shape[0]
+        Q = self.ivf["Q"]  # cluster centers
+        order = self.ivf["order"]  # centroid indices sorted by cluster
+        offsets = self.ivf["offsets"]  # cluster boundaries in "order"
+
+        # closest clusters, norms of D are same for all of them
+        qdist = np.dot(D, Q.T.astype(self.dtype)) * -2 + self.ivf["Q2"]
+        probe, _ = _ksmallest(qdist, min(cf._ivf_probe, Q.shape[0]))
+
+        best_idx = np.zeros((L, k), dtype=np.intp) - 1
+        best_dist = np.zeros((L, k), dtype=self.dtype) + np.inf
+        for j in np.unique(probe):
+            members = order[offsets[j]:offsets[j+1]]
+            if len(members) == 0:
+                continue
+            rows = np.where((probe == j).any(1))[0]
+            dist = _sqdist(D[rows], D2[rows], self.C[members], self.C2[members])
+            b_idx, b_dist = _ksmallest(dist, k)
+            # merge cluster candidates with the best ones so far
+            cand_idx = np.hstack((best_idx[rows], members[b_idx]))
+            cand_dist = np.hstack((best_dist[rows], b_dist))
+            sel, best_dist[rows] = _ksmallest(cand_dist, k)
+            best_idx[rows] = cand_idx[np.arange(len(rows))[:, None], sel]
+
+        miss = np.where(best_idx[:, -1] < 0)[0]
+        if len(miss) > 0:
+            best_idx[miss], best_dist[miss] = self._gemm_knn(D[miss], k)
+        return best_idx, best_dist.astype(np.float64)
 
 
     def get_1nn(self, D):
         """Get indices of the first nearest neighbours.
-        
+
         Transferring back indices only is faster that
         the whole distance matrix.
         """
         if self.C is None:
             return "Uninitialized centroids"
-        
+
+        if self.ivf is not None:
+            k_idx, k_dist = self._ivf_knn(D, 1)
+            return (k_idx[:, 0], k_dist[:, 0])
+        if self.engine in ("gemm", "uint8"):
+            k_idx, k_dist = self._gemm_knn(D, 1)
+            return (k_idx[:, 0], k_dist[:, 0])
+
         dist = distance.cdist(D, self.C, 'sqeuclidean')
         inds = np.argmin(dist, 1)
         l = range(len(inds))
@@ -47,24 +225,37 @@ class PDist(object):
         return (inds, dsts)
 
 
+    def get_repr(self, D, count):
+        """Get representations of images instead of their neighbours.
+
+        D = descriptors of consecutive images
+        count = number of descriptors of each image, all larger than 0
+        Representation is a mean of majority and soft labels of the first
+        nearest centroid of every descriptor, same as in "img_repr.Repr".
+        """
+        if self.L_mj is None:
+            return "Uninitialized centroids"
+        c = self.get_1nn(D)[0]
+        L = np.hstack((self.L_mj[c], self.L_soft[c]))
+        images = np.repeat(np.arange(len(count)), count)
+        return group_sum(images, L, len(count)) / np.asarray(count)[:, None]
+
+
     def get_knn(self, D):
         """Get indices of the first nearest neighbours.
-        
+
         Transferring back indices only is faster that
         the whole distance matrix.
         """
         if self.C is None:
             return "Uninitialized centroids"
 
-        
-        dist = distance.cdist(D, self.C, 'sqeuclidean')
-        L = D.shape[0]  # number of samples
         k = cf._nn_count  # number of nearest neighbours
-        k_idx = argpartsort(dist, k, 1)[:, :k]  # getting K smallest indices, unordered
-        k_dist = dist[[[t]*k for t in xrange(L)], k_idx]  # get distances, unordered
-        idx = np.argsort(k_dist, 1)  # get correct ordering
-        k_dist = k_dist[[[t]*k for t in xrange(L)], idx]  # apply ordering to distances
-        k_idx = k_idx[[[t]*k for t in xrange(L)], idx]  # apply ordering to indices
-        
-        return (k_idx, k_dist)
+        if self.ivf is not None:
+            return self._ivf_knn(D, k)
+        if self.engine in ("gemm", "uint8"):
+            return self._gemm_knn(D, k)
+
+        dist = distance.cdist(D, self.C, 'sqeuclidean')
+        return _ksmallest(dist, k)
 
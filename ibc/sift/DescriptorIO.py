@@ -1,4 +1,4 @@
-import os, struct
+import os, io, struct
 import numpy             # you need to have NumPy installed
 
 def __pointsToMatrix(points):
@@ -40,36 +40,85 @@ def parseKoen1(data, parsePoints=False):
         points = __pointsToMatrix(points)
     return points, numpy.matrix(descriptors, dtype=numpy.float64)
 
-def parseBinaryDescriptors(data):
-    """Parse the BINDESC1 format into two matrices: points and descriptors.
-    
-    Data contains the raw bytes of the file."""
-    header = data[0:32]
+def __parseBinaryHeader(header):
+    """Parse 32 bytes of BINDESC1 header into sizes and element type."""
     assert header[:8] == "BINDESC1"
     #assert header[8:16] == "CIRCLE  "
-    values = struct.unpack("<4I", header[16:])
+    values = struct.unpack("<4I", header[16:32])
     elementsPerPoint = values[0]
     dimensionCount = values[1]
     pointCount = values[2]
     bytesPerElement = values[3]
-    
+
     if bytesPerElement == 8:
         dt = numpy.float64
     elif bytesPerElement == 4:
         dt = numpy.float32
     else:
         raise ValueError("Bytes per element unknown: %d" % bytesPerElement)
+    return elementsPerPoint, dimensionCount, pointCount, dt
 
-    # New way of point and descriptor extraction
-    points = numpy.fromstring(data[32:(elementsPerPoint * pointCount * bytesPerElement)+32], dtype=dt)
-    descriptors = numpy.fromstring(data[(elementsPerPoint * pointCount * bytesPerElement)+32:], dtype=dt)
+def __splitBinary(buf, header, asUint8):
+    """Make points and descriptors from a buffer with data after the header.
 
-    # Reshape the arrays into matrices 
-    points = numpy.reshape(points, (pointCount, elementsPerPoint))
-    descriptors = numpy.reshape(descriptors, (pointCount, dimensionCount))
- 
+    Both are views of the buffer, no data is copied unless asUint8 is set."""
+    elementsPerPoint, dimensionCount, pointCount, dt = __parseBinaryHeader(header)
+    pointBytes = elementsPerPoint * pointCount * numpy.dtype(dt).itemsize
+    descrBytes = dimensionCount * pointCount * numpy.dtype(dt).itemsize
+    points = buf[:pointBytes].view(dt).reshape((pointCount, elementsPerPoint))
+    descriptors = buf[pointBytes:pointBytes + descrBytes].view(dt)
+    descriptors = descriptors.reshape((pointCount, dimensionCount))
+    if asUint8:
+        descriptors = descriptors.astype(numpy.uint8)
     return points, descriptors
 
+def parseBinaryDescriptors(data, asUint8=False):
+    """Parse the BINDESC1 format into two matrices: points and descriptors.
+    
+    Data contains the raw bytes of the file. Matrices are read-only views
+    of these bytes."""
+    buf = numpy.frombuffer(data, dtype=numpy.uint8, offset=32)
+    return __splitBinary(buf, data[0:32], asUint8)
+
+def __readExactly(f, buf):
+    """Fill a numpy buffer from file, pipe or socket without extra copies."""
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        n = f.readinto(view[pos:])
+        if not n:
+            raise IOError("Unexpected end of descriptors data")
+        pos += n
+
+def readBinaryDescriptors(source, asUint8=False, useMmap=False):
+    """Load BINDESC1 descriptors from filename, file object or file descriptor.
+
+    A file descriptor may be a pipe, so extractor output does not need to
+    be written to disk. Data is read once into a preallocated buffer (or
+    memory-mapped if useMmap is set for a filename), and the returned
+    points and descriptors are views of it. With asUint8, descriptors are
+    converted to uint8 in one step."""
+    if isinstance(source, (int, long)):
+        f = io.open(source, "rb", closefd=False)
+    elif hasattr(source, "readinto"):
+        f = source
+    elif useMmap:
+        buf = numpy.memmap(source, dtype=numpy.uint8, mode="r")
+        return __splitBinary(buf[32:], buf[:32].tostring(), asUint8)
+    else:
+        f = io.open(source, "rb")
+
+    header = numpy.empty((32,), dtype=numpy.uint8)
+    __readExactly(f, header)
+    header = header.tostring()
+    elementsPerPoint, dimensionCount, pointCount, dt = __parseBinaryHeader(header)
+    nbytes = (elementsPerPoint + dimensionCount) * pointCount * numpy.dtype(dt).itemsize
+    buf = numpy.empty((nbytes,), dtype=numpy.uint8)
+    __readExactly(f, buf)
+    if f is not source:
+        f.close()
+    return __splitBinary(buf, header, asUint8)
+
 def readDescriptors(filename):
     """Load descriptors from filename or file descriptor.
     
@@ -89,24 +138,7 @@ def readDescriptors(filename):
         return parseKoen1(f.read(), True)
         
     # this is a binary file
-    header = f.read(32)
-    assert header[:8] == "BINDESC1"
-    #assert header[8:16] == "CIRCLE  "
-    values = struct.unpack("<4I", header[16:])
-    elementsPerPoint = values[0]
-    dimensionCount = values[1]
-    pointCount = values[2]
-    bytesPerElement = values[3]
-    if bytesPerElement == 8:
-        dt = numpy.float64
-    elif bytesPerElement == 4:
-        dt = numpy.float32
-    else:
-        raise ValueError("Bytes per element unknown: %d" % bytesPerElement)
-    points = numpy.fromstring(f.read(elementsPerPoint * pointCount * bytesPerElement), dtype=dt)
-    descriptors = numpy.fromstring(f.read(dimensionCount * pointCount * bytesPerElement), dtype=dt)
-    points = numpy.reshape(points, (pointCount, elementsPerPoint))
-    descriptors = numpy.reshape(descriptors, (pointCount, dimensionCount))
+    points, descriptors = readBinaryDescriptors(f)
     if not hasattr(filename, "read"):
         f.close()
     return points, descriptors
@@ -6,20 +6,62 @@ If something goes wrong, returns string describing the error.
 """
 
 from ibc_config import IBCConfig as cf
-from sift.DescriptorIO import readDescriptors
+from sift.DescriptorIO import readBinaryDescriptors
+from modules.img_preprocessor import _decode
 import numpy as np
 import os
 import shutil  # to remove directory with subdirectories
 
+# one record per image region
+region_dtype = np.dtype([("index", np.int64),
+                         ("center", np.int64, (2,)),
+                         ("radius", np.int64),
+                         ("cornerness", np.float64)])
 
-def csift(img_file, idx):
-    """Calculates and returns descriptors of one image.
+
+def _temp_dir(idx):
+    """Creates temporary directory of a worker, preferably in RAM.
     """
-    # creating temporary directory, preferably in RAM
     temp_dir = os.path.join(cf._temp_dir, str(idx))
     if not os.path.isdir(temp_dir):
         os.mkdir(temp_dir)
-    
+    return temp_dir
+
+
+def _empty_result():
+    """Result of an image without regions.
+    """
+    return {"regions": np.zeros((0,), dtype=region_dtype),
+            "descriptors": np.zeros((0, 384), dtype=np.uint8)}
+
+
+def _read_data(temp_file):
+    """Reads descriptors from extractor output.
+
+    Returns regions as one structured array, and descriptors as one
+    (n, 384) uint8 array.
+    """
+    regs, descrs = readBinaryDescriptors(temp_file, asUint8=True)
+    if regs.shape[1] != 5:  # if there are no regions
+        regs = np.zeros((0, 5))
+        descrs = np.zeros((0, descrs.shape[1]), dtype=np.uint8)
+    n = regs.shape[0]
+    regions = np.empty((n,), dtype=region_dtype)
+    regions["index"] = np.arange(n)
+    regions["center"] = regs[:, :2]  # truncated to int64
+    regions["radius"] = regs[:, 2]*8.4853
+    regions["cornerness"] = regs[:, 4]
+    data = {}
+    data["regions"] = regions
+    data["descriptors"] = np.ascontiguousarray(descrs)
+    return data
+
+
+def csift(img_file, idx):
+    """Calculates and returns descriptors of one image.
+    """
+    temp_dir = _temp_dir(idx)
+
     # extracting descriptors, dropping console output
     # works for LINUX
     temp_file = os.path.join(temp_dir, "descriptors.bin")
@@ -29,54 +71,94 @@ def csift(img_file, idx):
                % (cf._cD_bin, img_file, temp_file, cf._max_reg))
     os.system(command)  # running "colorDescriptors" for one image, one thread
 
-    # reading data        
-    regs, descrs = readDescriptors(temp_file)
-    data = {}
-    data["regions"] = []
-    data["descriptors"] = []
-    if regs.shape[1] == 5:  # if there are regions
-        i = 0
-        for region in regs:
-            i0 = i  # idx
-            i1 = np.int64(region[:2])  # center
-            i2 = np.int64(region[2]*8.4853)  # radius
-            i3 = np.float64(region[4])  # cornerness
-            data["regions"].append([i0, i1, i2, i3])
-            i += 1
-        for descriptor in descrs:
-            descr_uint8 = np.asarray(descriptor, dtype=np.uint8)
-            data["descriptors"].append(descr_uint8)    
-    
+    # reading data
+    data = _read_data(temp_file)
     os.remove(temp_file)  # cleaning temp directory
-    return data    
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    return data
 
 
+def csift_batch(img_files, idx):
+    """Calculates descriptors of many images with one extractor run.
 
+    "colorDescriptor" takes a text file with a list of images as input,
+    and writes a separate output for each of them to "--outputBasePath",
+    named as the image plus "_cD_suffix". Images are linked into temporary
+    directory under unique names, so that output names do not clash for
+    images with same file names. Images without output (extractor failed)
+    are re-run one by one, with a warning.
 
+    Returns a list of results, in the order of "img_files".
+    """
+    temp_dir = os.path.join(_temp_dir(idx), "batch")
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)  # leftovers of a crashed run
+    os.mkdir(temp_dir)
+
+    names = []
+    for i, img_file in enumerate(img_files):
+        name = "%06d%s" % (i, os.path.splitext(img_file)[1])
+        os.symlink(os.path.abspath(img_file), os.path.join(temp_dir, name))
+        names.append(name)
+    list_file = os.path.join(temp_dir, "filelist.txt")
+    open(list_file, "w").write("\n".join(names) + "\n")
+
+    command = ('cd %s && %s %s --detector harrislaplace --descriptor csift '
+               '--outputBasePath %s --outputFormat binary '
+               '--keepLimited %d > /dev/null'
+               % (temp_dir, cf._cD_bin, list_file, temp_dir + "/",
+                  cf._max_reg))
+    os.system(command)  # one "colorDescriptors" run for all images
+
+    # output of image "000001.jpg" is "000001.jpg<_cD_suffix>"
+    outputs = [os.path.join(temp_dir, name + cf._cD_suffix) for name in names]
+    missing = sum(not os.path.isfile(f) for f in outputs)
+    if missing > 0:
+        print ("Warning: no batch output for %d of %d images, running them "
+               "one by one; check '_cD_suffix'" % (missing, len(names)))
+
+    results = []
+    for img_file, out_file in zip(img_files, outputs):
+        if os.path.isfile(out_file):
+            results.append(_read_data(out_file))
+        else:
+            results.append(csift(img_file, idx))
+    shutil.rmtree(temp_dir)  # cleaning temp directory
+    return results
+
+
+def csift_raw(images, idx):
+    """Calculates descriptors of original images, normalizing them in RAM.
+
+    Used with "shm" hand-off, images are (raw file, preprocessed file).
+    Each image is decoded and resized only here, saved as a lossless PPM
+    in the temporary directory of a worker, and removed after extraction;
+    so a worker keeps only one batch of them. Preprocessed JPEG is written
+    too if "_save_img". Images which cannot be decoded get no regions.
+    """
+    temp_dir = os.path.join(_temp_dir(idx), "handoff")
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)  # leftovers of a crashed run
+    os.mkdir(temp_dir)
+
+    img_files = []
+    for i, (raw_file, img_new) in enumerate(images):
+        img_file = os.path.join(temp_dir, "%06d.ppm" % i)
+        try:
+            img_obj, _ = _decode(open(raw_file, 'rb').read(), cf._fast_resize)
+            img_obj.save(img_file, 'PPM')
+            if cf._save_img:
+                img_obj.save(img_new, 'JPEG', quality=cf._jpeg_quality)
+        except Exception:
+            img_file = None
+        img_files.append(img_file)
+
+    valid = [f for f in img_files if f is not None]
+    found = iter(csift_batch(valid, idx) if len(valid) > 0 else [])
+    results = []
+    for img_file in img_files:
+        if img_file is None:
+            results.append(_empty_result())
+        else:
+            results.append(found.next())
+    shutil.rmtree(temp_dir)
+    return results
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of writing regions and descriptors to HDF5 tables.
+
+Compares the old way (one "Table.row" with per-field assignment for each
+region and descriptor, and an Images update for each image) with building
+arrays of rows and appending them at once together with Images updates,
+as "get_descriptors.Master" does now; for both descriptor layouts.
+
+Usage: "python bench_hdf5_writer.py [number_of_images]"
+"""
+
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ibc_config import IBCConfig as cf
+from config.config_hdf5 import ImagesRecord, RegionsRecord
+from modules.hdf5_creator import empty_rows, create_descr, DescriptorStore
+from modules.work_ranges import runs
+from sift.csift_extractor import region_dtype
+from tables import openFile
+import numpy as np
+import tempfile
+import time
+
+N_REG = 300  # regions per image, typical values are 100-500
+
+
+def _fake_result(n):
+    regions = np.zeros((n,), dtype=region_dtype)
+    regions["index"] = np.arange(n)
+    regions["center"] = np.random.randint(0, 500, (n, 2))
+    regions["radius"] = np.random.randint(1, 50, n)
+    regions["cornerness"] = np.random.rand(n)
+    descriptors = np.random.randint(0, 256, (n, 384)).astype(np.uint8)
+    return regions, descriptors
+
+
+def _write_rows(Images, Regions, Descriptors, results):
+    last = -1
+    for idx, (regions, descriptors) in enumerate(results):
+        Images.modify_columns(idx, idx+1, columns=[[len(regions)], [last + 1]],
+                              names=["reg_count", "reg_first"])
+        for i in xrange(len(regions)):
+            rrow = Regions.row
+            rrow["index"] = last + i + 1
+            rrow["img_class"] = 1
+            rrow["img_site"] = 1
+            rrow["img_index"] = idx
+            rrow["center"] = regions["center"][i]
+            rrow["radius"] = regions["radius"][i]
+            rrow["cornerness"] = regions["cornerness"][i]
+            rrow.append()
+            drow = Descriptors.table.row
+            drow["index"] = last + i + 1
+            drow["classN"] = 1
+            drow["data"] = descriptors[i]
+            drow.append()
+        last += len(regions)
+    Images.flush()
+    Regions.flush()
+    Descriptors.flush()
+
+
+def _write_images(Images, img_rows):
+    img = np.array(img_rows, dtype=np.int64)
+    pos = 0
+    for start, stop in runs(img[:, 0]):
+        part = img[pos:pos + stop - start]
+        Images.modify_columns(start, stop, columns=[part[:, 1], part[:, 2]],
+                              names=["reg_count", "reg_first"])
+        pos += stop - start
+
+
+def _write_arrays(Images, Regions, Descriptors, results, group=10000):
+    last = -1
+    img_rows = []
+    reg_buf = []
+    des_buf = []
+    rows = 0
+    for idx, (regions, descriptors) in enumerate(results):
+        n = len(regions)
+        img_rows.append((idx, n, last + 1))
+        reg = empty_rows(Regions, n)
+        reg["index"] = np.arange(last + 1, last + n + 1)
+        reg["img_class"] = 1
+        reg["img_site"] = 1
+        reg["img_index"] = idx
+        reg["center"] = regions["center"]
+        reg["radius"] = regions["radius"]
+        reg["cornerness"] = regions["cornerness"]
+        reg_buf.append(reg)
+        des_buf.append(descriptors)
+        last += n
+        rows += n
+        if (rows >= group) or (idx == len(results) - 1):
+            _write_images(Images, img_rows)
+            Regions.append(np.concatenate(reg_buf))
+            des = np.concatenate(des_buf)
+            Descriptors.append(np.ones((len(des),), dtype=np.int8), des)
+            img_rows = []
+            reg_buf = []
+            des_buf = []
+            rows = 0
+    Images.flush()
+    Regions.flush()
+    Descriptors.flush()
+
+
+def bench_writer(n_img=200):
+    results = [_fake_result(N_REG) for _ in xrange(n_img)]
+    rows = n_img * N_REG
+    for name, writer, layout in (("row by row", _write_rows, "table"),
+                                 ("arrays", _write_arrays, "table"),
+                                 ("arrays, earray", _write_arrays, "earray")):
+        fname = tempfile.mktemp(suffix=".h5")
+        db = openFile(fname, "w")
+        Images = db.createTable(db.root, "Images", ImagesRecord)
+        Images.append(empty_rows(Images, n_img))
+        Regions = db.createTable(db.root, "Regions", RegionsRecord)
+        create_descr(db, layout)
+        Descriptors = DescriptorStore(db)
+        t = time.time()
+        writer(Images, Regions, Descriptors, results)
+        t = time.time() - t
+        db.close()
+        size = os.path.getsize(fname) / 2.0**20
+        os.remove(fname)
+        print "%s: %.0f rows/s (%d rows in %.2fs), %.0f MB" % (name, rows / t,
+                                                               rows, t, size)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench_writer(int(sys.argv[1]))
+    else:
+        bench_writer()
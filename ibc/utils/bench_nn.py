@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the nearest neighbour stage (PDist.get_knn / get_1nn).
+
+Sweeps batch size ("_nn_batch"), number of neighbours ("_nn_count"),
+number of centroids, engine with its dtype, and number of BLAS threads.
+Each configuration runs in a separate process, so thread count can be set
+through environment and peak memory is measured for that configuration only.
+
+Results are appended as JSON lines to a file (default "_dir/bench_nn.jsonl"),
+one line per configuration, to compare runs on different hardware or code.
+
+Usage: "python bench_nn.py [output_file]"
+"""
+
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ibc_config import IBCConfig as cf
+import numpy as np
+import subprocess
+import resource
+import platform
+import socket
+import json
+import time
+
+BATCH = [100, 1000, 10000]
+NN_COUNT = [1, 10]
+CENTROIDS = [10000, 100000]
+ENGINES = [("cdist", "float64"), ("gemm", "float64"), ("gemm", "float32"),
+           ("uint8", "float32")]
+THREADS = [1, 4, 16]
+N_DESCR = 10000  # descriptors processed in each configuration
+DIM = 384
+
+
+def _peak_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_single(param):
+    """Runs one configuration in the current process, returns results.
+    """
+    from nn.pdist import PDist
+    cf._nn_batch = param["batch"]
+    cf._nn_count = param["k"]
+    cf._nn_engine = param["engine"]
+    cf._nn_dtype = param["dtype"]
+
+    np.random.seed(0)
+    C = np.random.rand(param["centroids"], DIM) * 255
+    D = np.random.randint(0, 256, (N_DESCR, DIM)).astype(np.uint8)
+    pd = PDist(C)
+    base_mb = _peak_mb()
+
+    t = time.time()
+    for i in xrange(0, N_DESCR, cf._nn_batch):
+        batch = D[i:i+cf._nn_batch]
+        if cf._nn_engine == "cdist":  # cdist converts to float64 anyway
+            batch = batch.astype(np.float64)
+        if cf._nn_count == 1:
+            pd.get_1nn(batch)
+        else:
+            pd.get_knn(batch)
+    t = time.time() - t
+
+    result = dict(param)
+    result["n_descr"] = N_DESCR
+    result["descr_per_s"] = N_DESCR / t
+    result["time"] = t
+    result["base_mb"] = base_mb
+    result["peak_mb"] = _peak_mb()
+    return result
+
+
+def run_sweep(out_file):
+    """Runs all configurations, each one in a new process.
+    """
+    info = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "numpy": np.__version__}
+    f = open(out_file, "a")
+    for threads in THREADS:
+        env = dict(os.environ)
+        for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS"):
+            env[var] = str(threads)
+        for n_c in CENTROIDS:
+            for engine, dtype in ENGINES:
+                for k in NN_COUNT:
+                    for batch in BATCH:
+                        param = {"threads": threads, "centroids": n_c,
+                                 "engine": engine, "dtype": dtype,
+                                 "k": k, "batch": batch}
+                        p = subprocess.Popen([sys.executable, __file__,
+                                              "--single", json.dumps(param)],
+                                             env=env, stdout=subprocess.PIPE)
+                        out = p.communicate()[0]
+                        if p.returncode != 0:
+                            print "Failed: %s" % param
+                            continue
+                        result = json.loads(out.splitlines()[-1])
+                        result.update(info)
+                        f.write(json.dumps(result, sort_keys=True) + "\n")
+                        f.flush()
+                        print ("%(engine)s/%(dtype)s threads=%(threads)d "
+                               "C=%(centroids)d k=%(k)d batch=%(batch)d: "
+                               "%(descr_per_s).0f descr/s, "
+                               "peak %(peak_mb).0f MB" % result)
+    f.close()
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) > 2) and (sys.argv[1] == "--single"):
+        print json.dumps(run_single(json.loads(sys.argv[2])))
+    else:
+        if len(sys.argv) > 1:
+            out_file = sys.argv[1]
+        else:
+            out_file = cf._dir + "bench_nn.jsonl"
+        run_sweep(out_file)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Compares fast JPEG draft-mode resize with the normal one.
+
+For a sample of raw images, both paths of "img_preprocessor._decode" are
+timed, and the results are compared as images (PSNR) and by what matters
+for classification: number of local regions, and image representation
+built from nearest centroids of their descriptors.
+
+Usage: "python compare_resize.py [number_of_images]"
+"""
+
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ibc_config import IBCConfig as cf
+from modules.img_preprocessor import _decode
+from modules.img_repr import Repr
+from sift.csift_extractor import csift
+from nn.pdist import PDist
+import numpy as np
+import time
+
+
+def _sample_images(n):
+    """Raw data of first n JPEG images from "_raw_dir".
+    """
+    files = []
+    for root, dirs, fnames in os.walk(cf._raw_dir):
+        for f in fnames:
+            raw = open(os.path.join(root, f), 'rb').read()
+            if raw[:2] != "\xff\xd8":  # not a JPEG
+                continue
+            files.append(raw)
+            if len(files) >= n:
+                return files
+    return files
+
+
+def _representation(img_obj, pd, rp):
+    """Number of regions and representation of an image.
+    """
+    img_file = os.path.join(cf._temp_dir, "compare_resize.png")
+    img_obj.save(img_file, 'PNG')  # lossless, to compare resize only
+    data = csift(img_file, "compare_resize")
+    os.remove(img_file)
+    n = len(data["regions"])
+    if n == 0:
+        return 0, None
+    c, d = pd.get_knn(data["descriptors"])
+    return n, rp._repr(c[:, 0], d)
+
+
+def compare_resize(n=100):
+    pd = PDist()
+    rp = Repr()
+    t_normal = t_fast = 0.0
+    psnr = []
+    regions = []
+    repr_diff = []
+    for raw in _sample_images(n):
+        t = time.time()
+        img1, size = _decode(raw, False)
+        t_normal += time.time() - t
+        t = time.time()
+        img2, _ = _decode(raw, True)
+        t_fast += time.time() - t
+        if img1.size == size:  # not resized at all
+            continue
+
+        a = np.asarray(img1, dtype=np.float64)
+        b = np.asarray(img2, dtype=np.float64)
+        mse = max(np.mean((a - b)**2), 1e-10)
+        psnr.append(10 * np.log10(255.0**2 / mse))
+
+        n1, r1 = _representation(img1, pd, rp)
+        n2, r2 = _representation(img2, pd, rp)
+        regions.append((n1, n2))
+        if (r1 is not None) and (r2 is not None):
+            repr_diff.append(np.sum(np.abs(r1 - r2)) / np.sum(np.abs(r1)))
+
+    regions = np.array(regions, dtype=np.float64)
+    print "Images resized: %d" % len(psnr)
+    print "Decode+resize time: normal %.2fs, fast %.2fs (%.1fx faster)" % \
+          (t_normal, t_fast, t_normal / max(t_fast, 1e-10))
+    print "PSNR fast vs normal: mean %.1f dB, min %.1f dB" % \
+          (np.mean(psnr), np.min(psnr))
+    print "Regions per image: normal %.1f, fast %.1f" % \
+          (np.mean(regions[:, 0]), np.mean(regions[:, 1]))
+    print "Relative L1 difference of image representations: " \
+          "mean %.3f, max %.3f" % (np.mean(repr_diff), np.max(repr_diff))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        compare_resize(int(sys.argv[1]))
+    else:
+        compare_resize()
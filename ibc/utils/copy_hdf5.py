@@ -1,4 +1,8 @@
-#from ../modules/hdf5_creator import create_empty_hdf5
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.hdf5_creator import DescriptorStore
 from tables import openFile
 import numpy as np
 
@@ -13,11 +17,11 @@ def copy_hdf5(data, new, batch=100000):
     Ws0 = db0.root.Websites
     Img0 = db0.root.Images
     Reg0 = db0.root.Regions
-    Des0 = db0.root.Descriptors
+    Des0 = DescriptorStore(db0)  # any descriptors layout
     Ws1 = db1.root.Websites
     Img1 = db1.root.Images
     Reg1 = db1.root.Regions
-    Des1 = db1.root.Descriptors
+    Des1 = DescriptorStore(db1)
 
     # websites
     N = Ws0.nrows
@@ -67,9 +71,9 @@ def copy_hdf5(data, new, batch=100000):
     for b in range(N/batch + 1):        
         nmin = b*batch
         nmax = min((b+1)*batch, N)
-        Des1.append(Des0.read(nmin, nmax))
+        Des1.append(Des0.read_class(nmin, nmax), Des0.read_range(nmin, nmax))
         print  "des: %d/%d" % (nmax, N)
-    Des1.attrs.last_index = Des0.attrs.last_index
+    Des1.last_index = Des0.last_index
     Des1.flush()
 
     db0.close()
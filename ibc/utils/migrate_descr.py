@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Converts descriptors of an existing HDF5 file to "_descr_layout".
+
+Descriptors are copied in chunks into a storage of the new layout
+(see "hdf5_creator.create_descr"), then the old one is removed.
+Conversion works both ways, "table" to "earray" and back. The file is
+changed in place; use "ptrepack" afterwards to reclaim free space.
+
+Usage: "python migrate_descr.py [hdf5_file]"
+"""
+
+import sys
+import os
+if __name__ == "__main__":  # run as a script, "ibc_config" is one folder up
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ibc_config import IBCConfig as cf
+from modules.hdf5_creator import DescriptorStore, create_descr
+from tables import openFile
+
+
+def migrate_descr(fname, batch=100000):
+    if not os.path.isfile(fname):
+        print "No HDF5 file %s" % fname
+        return
+    db = openFile(fname, "a")
+    old = DescriptorStore(db)
+    if old.layout == cf._descr_layout:
+        print "Descriptors are already stored as '%s'" % old.layout
+        db.close()
+        return
+
+    # old nodes are renamed, so that the new ones can take their names
+    if old.layout == "earray":
+        db.renameNode(db.root.DescrData, "DescrData_old")
+        db.renameNode(db.root.DescrClass, "DescrClass_old")
+    else:
+        db.renameNode(db.root.Descriptors, "Descriptors_old")
+    create_descr(db, cf._descr_layout)
+    new = DescriptorStore(db)
+
+    N = old.nrows
+    for nmin in xrange(0, N, batch):
+        nmax = min(nmin + batch, N)
+        new.append(old.read_class(nmin, nmax), old.read_range(nmin, nmax))
+        print "des: %d/%d" % (nmax, N)
+    new.last_index = old.last_index
+    new.flush()
+
+    if old.layout == "earray":
+        db.removeNode(db.root, "DescrData_old")
+        db.removeNode(db.root, "DescrClass_old")
+    else:
+        db.removeNode(db.root, "Descriptors_old")
+    db.close()
+    print "Done migrating!"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        migrate_descr(sys.argv[1])
+    else:
+        migrate_descr(cf._hdf5)